@@ -38,6 +38,9 @@ install --directory ${RPM_BUILD_ROOT}/etc/init.d
 install --mode 755 $RPM_BUILD_DIR/src/skel/etc/init.d/pack-system ${RPM_BUILD_ROOT}/etc/init.d/pack-system
 install --directory ${RPM_BUILD_ROOT}/usr/local/bin
 install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/dcap.py ${RPM_BUILD_ROOT}/usr/local/bin/dcap.py
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/dcapzip.py ${RPM_BUILD_ROOT}/usr/local/bin/dcapzip.py
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/asyncdcap.py ${RPM_BUILD_ROOT}/usr/local/bin/asyncdcap.py
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/sfdb.py ${RPM_BUILD_ROOT}/usr/local/bin/sfdb.py
 install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/pack-files.py ${RPM_BUILD_ROOT}/usr/local/bin/pack-files.py
 install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/fillmetadata.py ${RPM_BUILD_ROOT}/usr/local/bin/fillmetadata.py
 install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/writebfids.py ${RPM_BUILD_ROOT}/usr/local/bin/writebfids.py
@@ -50,6 +53,9 @@ install --mode 755 $RPM_BUILD_DIR/src/skel/etc/systemd/system/writebfids.service
 /etc/dcache/container.conf
 /etc/init.d/pack-system
 /usr/local/bin/dcap.py
+/usr/local/bin/dcapzip.py
+/usr/local/bin/asyncdcap.py
+/usr/local/bin/sfdb.py
 /usr/local/bin/pack-files.py
 /usr/local/bin/fillmetadata.py
 /usr/local/bin/writebfids.py
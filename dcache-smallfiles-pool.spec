@@ -15,7 +15,7 @@ Distribution: dCache
 Prefix: %{_prefix}
 Vendor: dCache.org
 Packager: dCache <support@dcache.org>
-Requires: dcap-libs, 
+Requires: dcap-libs, python3, python3-pymongo
 
 %description
 dcache-smallfiles is a collection of scripts running as a service
@@ -36,8 +36,19 @@ mv SmallFiles*/* .
 install --directory ${RPM_BUILD_ROOT}/usr/share/dcache/lib
 install --mode 755 $RPM_BUILD_DIR/src/skel/usr/share/dcache/lib/hsm-internal.sh ${RPM_BUILD_ROOT}/usr/share/dcache/lib/hsm-internal.sh
 install --mode 755 $RPM_BUILD_DIR/src/skel/usr/share/dcache/lib/datasetPut.js ${RPM_BUILD_ROOT}/usr/share/dcache/lib/datasetPut.js
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/share/dcache/lib/hsm-helper.py ${RPM_BUILD_ROOT}/usr/share/dcache/lib/hsm-helper.py
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/share/dcache/lib/hsm-client.py ${RPM_BUILD_ROOT}/usr/share/dcache/lib/hsm-client.py
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/dcap.py ${RPM_BUILD_ROOT}/usr/share/dcache/lib/dcap.py
+install --mode 755 $RPM_BUILD_DIR/src/skel/usr/local/bin/dcapzip.py ${RPM_BUILD_ROOT}/usr/share/dcache/lib/dcapzip.py
+install --directory ${RPM_BUILD_ROOT}/etc/systemd/system
+install --mode 755 $RPM_BUILD_DIR/src/skel/etc/systemd/system/hsm-helper.service ${RPM_BUILD_ROOT}/etc/systemd/system/hsm-helper.service
 
 %files
 /usr/share/dcache/lib/hsm-internal.sh
 /usr/share/dcache/lib/datasetPut.js
+/usr/share/dcache/lib/hsm-helper.py
+/usr/share/dcache/lib/hsm-client.py
+/usr/share/dcache/lib/dcap.py
+/usr/share/dcache/lib/dcapzip.py
+/etc/systemd/system/hsm-helper.service
 
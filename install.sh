@@ -27,6 +27,9 @@ then
   cp "${SRC_BIN}/fillmetadata.py" "${LOCAL_BIN}"
   cp "${SRC_BIN}/writebfids.py" "${LOCAL_BIN}"
   cp "${SRC_BIN}/dcap.py" "${LOCAL_BIN}"
+  cp "${SRC_BIN}/dcapzip.py" "${LOCAL_BIN}"
+  cp "${SRC_BIN}/asyncdcap.py" "${LOCAL_BIN}"
+  cp "${SRC_BIN}/sfdb.py" "${LOCAL_BIN}"
   if [ ${2} != "--update" ];
   then
     echo "Copying configuration file to ${LOCAL_ETC}"
@@ -36,8 +39,8 @@ then
     mkdir -p "${LOCAL_LOG}"
   fi
 
-  echo "Make sure your MongoDB is accessible from the pools and the packing machines"
-  echo "and has an index on ctime on the smallfiles database."
+  echo "Make sure your MongoDB is accessible from the pools and the packing machines."
+  echo "The required indexes on the smallfiles database are created on startup."
   echo ""
   echo "To get started edit the configuration in /etc/dcache/container.conf."
 fi
@@ -47,6 +50,10 @@ then
   echo "Copying hsm scripts to ${DCACHE_LIB}"
   cp "${SRC_LIB}/hsm-internal.sh" "${DCACHE_LIB}"
   cp "${SRC_LIB}/datasetPut.js" "${DCACHE_LIB}"
+  cp "${SRC_LIB}/hsm-helper.py" "${DCACHE_LIB}"
+  cp "${SRC_LIB}/hsm-client.py" "${DCACHE_LIB}"
+  cp "${SRC_BIN}/dcap.py" "${DCACHE_LIB}"
+  cp "${SRC_BIN}/dcapzip.py" "${DCACHE_LIB}"
 
   echo "To setup a pool to use the hsm-internal.sh script, set the following properties (adjusted to your system) on your pool:"
   echo ""
@@ -57,6 +64,10 @@ then
   echo ""
   echo "On the directory that will hold the small files, set the sGroup and OSMTemplate tags to s.th. appropriate"
   echo "Then set the hsmInstance tag on that directory to 'dcache'"
+  echo ""
+  echo "Optionally start ${DCACHE_LIB}hsm-helper.py as the user running the pool, e.g. with hsm-helper.service"
+  echo "(set User= and Group= there if the pool does not run as dcache). While it is running,"
+  echo "hsm-internal.sh hands all requests to it instead of starting the mongo shell for each of them."
 fi
 
 echo "finished."
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Compares the candidate selection of pack-files.py before and after moving the sum/old-file decision into a
+# server-side aggregation. Both variants select with GroupPackager.candidate_query, on the indexes sfdb.py creates;
+# the aggregation is GroupPackager.summarize_candidates. Needs a scratch MongoDB; the collection is (re)created in
+# the given database.
+#
+# Usage: candidate_selection.py [<mongo uri>] [<database>] [<document count>]
+
+import os
+import re
+import sys
+import time
+import random
+import importlib.util
+from types import SimpleNamespace
+from pymongo import MongoClient, ASCENDING
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '../../skel/usr/local/bin'))
+spec = importlib.util.spec_from_file_location('pack_files', os.path.join(bench_dir,
+                                                                         '../../skel/usr/local/bin/pack-files.py'))
+pack_files = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pack_files)
+import sfdb
+
+mongo_uri = "mongodb://localhost/"
+mongo_db = "smallfiles_bench"
+doc_count = 1000000
+# the candidates are spread over this many directories, the packager selects one of them
+directories = 4
+
+
+def populate(db, count):
+    db.files.drop()
+    now = int(time.time())
+    batch = []
+    for i in range(count):
+        record = {'pnfsid': f"{i:036X}", 'status': 'new', 'path': f"/data/bench/dir{i % directories}/file{i}",
+                  'parent': f"/data/bench/dir{i % directories}", 'group': 'bench', 'store': 'bench',
+                  'size': random.randint(1000, 8000000), 'ctime': now - random.randint(0, 7 * 86400)}
+        if i // directories % 100 == 0:
+            # claimed by another packager
+            record['lock'] = 'other'
+        batch.append(record)
+        if len(batch) == 10000:
+            db.files.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db.files.insert_many(batch, ordered=False)
+    sfdb.ensure_indexes(db)
+
+
+def legacy_selection(packager, query, old_threshold):
+    # iterate, count, rewind, iterate: the way GroupPackager.run used to select candidates
+    streamed = 0
+    with packager.db.files.find(query, no_cursor_timeout=True).batch_size(512) as cursor:
+        cursor.sort('ctime', ASCENDING)
+        sumsize = 0
+        old_file_mode = False
+        for f in cursor:
+            streamed += 1
+            if f['ctime'] < old_threshold:
+                old_file_mode = True
+            sumsize += f['size']
+        filecount = packager.db.files.count_documents(query)
+        cursor.rewind()
+        for f in cursor:
+            streamed += 1
+    return streamed, filecount, sumsize, old_file_mode
+
+
+def aggregated_selection(packager, query, old_threshold):
+    # what GroupPackager.run does now
+    streamed = 0
+    filecount, sumsize, oldest = pack_files.GroupPackager.summarize_candidates(packager, query)
+    with packager.db.files.find(query, pack_files.CANDIDATE_FIELDS, no_cursor_timeout=True).batch_size(512) as cursor:
+        cursor.sort('ctime', ASCENDING)
+        for f in cursor:
+            streamed += 1
+    return streamed, filecount, sumsize, oldest is not None and oldest < old_threshold
+
+
+def main():
+    client = MongoClient(mongo_uri)
+    db = client[mongo_db]
+    print(f"Populating {mongo_db}.files with {doc_count} documents")
+    populate(db, doc_count)
+
+    # the attributes GroupPackager.candidate_query and summarize_candidates use
+    path = '/data/bench/dir1'
+    packager = SimpleNamespace(db=db, path=path, path_pattern=re.compile(os.path.join(path, '.*')),
+                               s_group=re.compile('bench'), store_name=re.compile('bench'))
+    now = int(time.time())
+    query = pack_files.GroupPackager.candidate_query(packager, now)
+    old_threshold = now - 86400
+
+    for name, selection in (('iterate-count-rewind-iterate', legacy_selection),
+                            ('aggregate-then-stream', aggregated_selection)):
+        start = time.time()
+        streamed, filecount, sumsize, old_file_mode = selection(packager, query, old_threshold)
+        elapsed = time.time() - start
+        print(f"{name:30s} files={filecount} size={sumsize} old={old_file_mode} "
+              f"passes={streamed / max(filecount, 1):.1f} streamed={streamed} time={elapsed:.2f}s")
+
+    db.files.drop()
+    client.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        mongo_uri = sys.argv[1]
+    if len(sys.argv) > 2:
+        mongo_db = sys.argv[2]
+    if len(sys.argv) > 3:
+        doc_count = int(sys.argv[3])
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Compares the compression methods pack-files.py offers for containers on the CSV files in src/main/resources/csv:
+# the ratio and single core throughput of each method, and how compressing scales over a pool of threads and of
+# processes. Each task compresses the whole corpus file by file, the way members are compressed.
+#
+# Usage: compression.py [<rounds> [<method>[:<level>] ...]]
+
+import os
+import sys
+import glob
+import time
+import importlib.util
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '../../skel/usr/local/bin'))
+spec = importlib.util.spec_from_file_location('pack_files', os.path.join(bench_dir,
+                                                                         '../../skel/usr/local/bin/pack-files.py'))
+pack_files = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pack_files)
+
+corpus_dir = os.path.join(bench_dir, '../resources/csv')
+rounds = 200
+methods = ['deflate:1', 'deflate:6', 'deflate:9', 'bzip2', 'lzma', 'zstd:3', 'zstd:19']
+
+
+def load_corpus():
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*.csv'))):
+        with open(path, 'rb') as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def compress_corpus(corpus, compression):
+    compressed = 0
+    for data in corpus:
+        compressed += len(pack_files.compress(data, compression))
+    return compressed
+
+
+def run_pool(executor, workers, corpus, compression, count):
+    with executor:
+        # workers are started before the clock runs
+        list(executor.map(len, [corpus] * workers))
+        start = time.time()
+        for future in [executor.submit(compress_corpus, corpus, compression) for _ in range(count)]:
+            future.result()
+        return time.time() - start
+
+
+def main():
+    corpus = load_corpus()
+    size = sum(len(data) for data in corpus)
+    print(f"corpus: {len(corpus)} files, {size} bytes, {rounds} rounds")
+
+    cpus = os.cpu_count() or 1
+    pool_sizes = sorted({1, 2, 4, cpus} & set(range(1, cpus + 1)))
+    context = multiprocessing.get_context('forkserver')
+    for method in methods:
+        if method.startswith('zstd') and pack_files.dcapzip.zstandard is None:
+            print(f"{method:10s} skipped, the zstandard module is not installed")
+            continue
+        compression = pack_files.parse_compression(method)
+
+        start = time.time()
+        for _ in range(rounds):
+            compressed = compress_corpus(corpus, compression)
+        elapsed = time.time() - start
+        print(f"{method:10s} ratio={size / compressed:.2f} 1 core={size * rounds / elapsed / 1e6:.1f} MB/s")
+
+        for workers in pool_sizes:
+            threads = run_pool(ThreadPoolExecutor(max_workers=workers), workers, corpus, compression, rounds)
+            processes = run_pool(ProcessPoolExecutor(max_workers=workers, mp_context=context), workers, corpus,
+                                 compression, rounds)
+            print(f"{'':10s} workers={workers:<3d} threads={size * rounds / threads / 1e6:.1f} MB/s "
+                  f"processes={size * rounds / processes / 1e6:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        methods = sys.argv[2:]
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Compares reading dcap control replies one byte per recv() with the buffered reader in dcap.py. A fake door on
+# localhost answers hello, rename and byebye, so only the client side of the control connection is measured.
+#
+# Usage: dcap_control.py [<round trips>]
+
+import os
+import sys
+import time
+import socket
+import threading
+import socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../skel/usr/local/bin'))
+from dcap import Dcap
+
+round_trips = 20000
+
+
+class FakeDoorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            s = line.decode('utf-8').split()
+            if s[3] == 'hello':
+                reply = "%s 0 server welcome 0 0" % s[0]
+            elif s[3] == 'byebye':
+                self.wfile.write(("%s 0 server byebye\n" % s[0]).encode('utf-8'))
+                break
+            else:
+                reply = "%s 0 server ok %s" % (s[0], " ".join(s[4:]))
+            self.wfile.write((reply + '\n').encode('utf-8'))
+
+
+class FakeDoor(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class LegacyDcap(Dcap):
+
+    def _rcv_control_msg(self):
+        # the reader dcap.py used before: one recv() per byte
+        msg = ''
+        while True:
+            chunk = self.socket.recv(1).decode('utf-8')
+            if chunk == '':
+                raise RuntimeError("socket connection broken")
+            if chunk == '\n':
+                break
+            msg = msg + chunk
+        return msg
+
+
+def run(cls, url, count):
+    start = time.time()
+    with cls(url) as dcap:
+        dcap.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for i in range(count):
+            dcap.rename(f"data/bench/file{i:08d}", f"/data/bench/renamed/file{i:08d}")
+    return time.time() - start
+
+
+def main():
+    server = FakeDoor(('localhost', 0), FakeDoorHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"dcap://localhost:{server.server_address[1]}/"
+
+    for name, cls in (('recv(1) per byte', LegacyDcap), ('buffered', Dcap)):
+        elapsed = run(cls, url, round_trips)
+        print(f"{name:20s} round trips={round_trips} time={elapsed:.2f}s "
+              f"per reply={elapsed / round_trips * 1e6:.1f}us")
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        round_trips = int(sys.argv[1])
+    main()
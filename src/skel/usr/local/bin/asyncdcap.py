@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# asyncio version of dcap.py: one control connection carries any number of concurrent opens, renames and closes,
+# and every file is transferred over its own data connection without a thread per transfer.
+
+from urllib.parse import urlparse
+import asyncio
+import struct
+import os
+import sys
+
+from dcap import VER_MAJ, VER_MIN, END_OF_DATA, DCAP_WRITE, DCAP_READ, DCAP_SEEK, DCAP_CLOSE, DCAP_READV, DATA, \
+    DCAP_SEEK_SET, WRITE_BUFFER_SIZE, READ_BUFFER_SIZE, ControlReply, _merge_string
+
+
+class AsyncDcap:
+    """dCache Client Access Protocol DCAP, for asyncio"""
+
+    def __init__(self, url):
+        u = urlparse(url)
+        self.host = u.hostname
+        self.port = u.port
+        self.root = u.path
+        self.seq = 0
+        self.streams = {}
+        # futures of the requests waiting for a reply and replies nobody waits for yet, by sequence number
+        self._waiting = {}
+        self._replies = {}
+        self._reader = None
+        self._writer = None
+        self._dispatcher = None
+
+    @classmethod
+    async def connect(cls, url):
+        dcap = cls(url)
+        await dcap._connect()
+        await dcap._send_hello()
+        return dcap
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line.endswith(b'\n'):
+                    raise RuntimeError("socket connection broken")
+                reply = ControlReply(line[:-1].decode('utf-8'))
+                future = self._waiting.pop(reply.seq, None)
+                if future is None:
+                    self._replies[reply.seq] = reply
+                elif not future.done():
+                    future.set_result(reply)
+        except Exception as e:
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._waiting.clear()
+
+    def _expect(self, seq):
+        future = asyncio.get_running_loop().create_future()
+        reply = self._replies.pop(seq, None)
+        if reply is not None:
+            future.set_result(reply)
+        elif self._dispatcher.done():
+            future.set_exception(RuntimeError("socket connection broken"))
+        else:
+            self._waiting[seq] = future
+        return future
+
+    async def _request(self, fmt, *args):
+        seq = self.seq
+        self.seq += 1
+        reply = self._expect(seq)
+        self._writer.write((fmt % ((seq,) + args) + '\n').encode('utf-8'))
+        await self._writer.drain()
+        return seq, await reply
+
+    async def _send_hello(self):
+        _, reply = await self._request("%d 0 client hello %d %d %d %d", VER_MAJ, VER_MIN, VER_MAJ, VER_MIN)
+        if reply.failed():
+            raise RuntimeError("door refused hello: " + _merge_string(reply.args))
+
+    async def open_file(self, path, mode='r', buffer_size=WRITE_BUFFER_SIZE, uid=None, gid=None, file_mode=0o644):
+        if '/' in path:
+            target = "\"dcap://%s:%d/%s/%s\"" % (self.host, self.port, self.root, path)
+        else:
+            # a pnfsid, e.g. of an archive
+            target = path
+        session, reply = await self._request(
+            "%d 0 client open %s %s localhost 1111 -passive -uid=%d -gid=%d -mode=0%o",
+            target, mode, os.getuid() if uid is None else uid, os.getgid() if gid is None else gid, file_mode)
+        if reply.failed():
+            raise RuntimeError("failed to open file " + path + ": " + _merge_string(reply.args[1:]))
+        host, port, chalange = reply.args[0], int(reply.args[1]), reply.args[2]
+
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(struct.pack('>II', session, len(chalange)) + chalange.encode('utf-8'))
+        await writer.drain()
+        stream = AsyncDcapStream(reader, writer, self, session, buffer_size)
+        stream.pnfsid = reply.option('pnfsid')
+        self.streams[session] = stream
+        return stream
+
+    async def rename(self, src, dest):
+        _, reply = await self._request("%d 0 client rename dcap://%s:%d/%s/%s %s",
+                                       self.host, self.port, self.root, src, dest)
+        if reply.failed():
+            raise RuntimeError("failed to rename " + src + ": " + _merge_string(reply.args[1:]))
+
+    async def close(self):
+        try:
+            await self._request("%d 0 client byebye")
+        finally:
+            self._dispatcher.cancel()
+            self._writer.close()
+
+
+class AsyncDcapStream:
+
+    def __init__(self, reader, writer, dcap, session, buffer_size=WRITE_BUFFER_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.dcap = dcap
+        self.session = session
+        self.pnfsid = None
+        self.buffer_size = buffer_size
+        self._write_buffer = bytearray()
+        self._writing = False
+        self.position = 0
+        self.closed = False
+        # one command at a time on the data connection
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _get_ack(self):
+        size = struct.unpack('>I', await self.reader.readexactly(4))[0]
+        return await self.reader.readexactly(size)
+
+    async def _get_data_into(self, view):
+        await self.reader.readexactly(8)
+        received = 0
+        while True:
+            count = struct.unpack('>I', await self.reader.readexactly(4))[0]
+            if count == END_OF_DATA:
+                await self._get_ack()
+                break
+            if received + count > len(view):
+                raise RuntimeError("door sent %d bytes more than requested" % (received + count - len(view)))
+            view[received:received + count] = await self.reader.readexactly(count)
+            received += count
+        return received
+
+    async def _read(self, count):
+        await self._end_write()
+        self.writer.write(struct.pack('>IIq', 12, DCAP_READ, count))
+        await self._get_ack()
+        data = bytearray(count)
+        n = await self._get_data_into(memoryview(data))
+        del data[n:]
+        self.position += n
+        return data
+
+    async def read(self, count=-1):
+        async with self._lock:
+            if count != -1:
+                return await self._read(count)
+            data = bytearray()
+            while True:
+                d = await self._read(READ_BUFFER_SIZE)
+                if len(d) == 0:
+                    return data
+                data.extend(d)
+
+    async def readv(self, iovecs):
+        async with self._lock:
+            await self._end_write()
+            msg = bytearray(struct.pack('>III', 8 + len(iovecs) * 12, DCAP_READV, len(iovecs)))
+            total = 0
+            for o, l in iovecs:
+                msg.extend(struct.pack('>QI', o, l))
+                total += l
+            self.writer.write(msg)
+            await self._get_ack()
+
+            data = memoryview(bytearray(total))
+            received = await self._get_data_into(data)
+            if received != total:
+                raise RuntimeError("readv returned %d of %d bytes" % (received, total))
+
+        slices = []
+        start = 0
+        for _, l in iovecs:
+            slices.append(data[start:start + l])
+            start += l
+        return slices
+
+    async def seek(self, offset, from_what=DCAP_SEEK_SET):
+        async with self._lock:
+            await self._end_write()
+            self.writer.write(struct.pack('>IIqI', 16, DCAP_SEEK, offset, from_what))
+            self.position = struct.unpack('>IIIq', await self._get_ack())[3]
+            return self.position
+
+    def tell(self):
+        return self.position
+
+    async def _start_write(self):
+        if self._writing:
+            return
+        self.writer.write(struct.pack('>II', 4, DCAP_WRITE))
+        await self._get_ack()
+        self.writer.write(struct.pack('>II', 4, DATA))
+        self._writing = True
+
+    async def _send_block(self, buf):
+        self.writer.write(struct.pack('>I', len(buf)))
+        self.writer.write(buf)
+        await self.writer.drain()
+
+    async def _flush(self):
+        if self._write_buffer:
+            await self._send_block(bytes(self._write_buffer))
+            self._write_buffer.clear()
+
+    async def _end_write(self):
+        if not self._writing:
+            return
+        await self._flush()
+        self.writer.write(struct.pack('>I', END_OF_DATA))
+        self._writing = False
+        await self._get_ack()
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush()
+
+    async def write(self, buf):
+        count = len(buf)
+        if count == 0:
+            return 0
+        async with self._lock:
+            await self._start_write()
+            if len(self._write_buffer) + count > self.buffer_size:
+                await self._flush()
+            if count >= self.buffer_size:
+                await self._send_block(buf)
+            else:
+                self._write_buffer.extend(buf)
+            self.position += count
+        return count
+
+    async def send_file(self, src):
+        async with self._lock:
+            await self._end_write()
+            size = os.stat(src).st_size
+            self.writer.write(struct.pack('>II', 4, DCAP_WRITE))
+            await self._get_ack()
+
+            self.writer.write(struct.pack('>III', 4, DATA, size))
+            with open(src, 'rb') as f:
+                await self.writer.drain()
+                # falls back to reading the file in the event loop where the transport can't sendfile
+                sent = await asyncio.get_running_loop().sendfile(self.writer.transport, f, 0, size)
+            if sent != size:
+                raise RuntimeError("%s changed size during upload: sent %d of %d bytes" % (src, sent, size))
+            self.writer.write(struct.pack('>I', END_OF_DATA))
+            await self._get_ack()
+            self.position += sent
+
+    async def recv_file(self, dst):
+        with open(dst, 'wb') as f:
+            while True:
+                async with self._lock:
+                    data = await self._read(READ_BUFFER_SIZE)
+                if len(data) == 0:
+                    break
+                f.write(data)
+
+    async def close(self):
+        async with self._lock:
+            if self.closed:
+                return
+            await self._end_write()
+            reply = self.dcap._expect(self.session)
+            self.writer.write(struct.pack('>II', 4, DCAP_CLOSE))
+            await self._get_ack()
+            reply = await reply
+            self.dcap.streams.pop(self.session, None)
+            self.writer.close()
+            self.closed = True
+        if reply.failed():
+            raise RuntimeError("failed to close file: " + _merge_string(reply.args))
+
+
+async def transfer(door, op, pairs):
+    async with await AsyncDcap.connect(door) as dcap:
+
+        async def one(local, remote):
+            async with await dcap.open_file(remote, 'w' if op == "PUT" else 'r') as f:
+                if op == "PUT":
+                    await f.send_file(local)
+                else:
+                    await f.recv_file(local)
+
+        await asyncio.gather(*[one(local, remote) for local, remote in pairs])
+
+
+def usage_and_exit():
+    print("Usage: asyncdcap <PUT|GET> <door> <local file> <remote file> [<local file> <remote file> ...]")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 5 or len(sys.argv) % 2 == 0 or sys.argv[1] not in ("PUT", "GET"):
+        usage_and_exit()
+
+    files = sys.argv[3:]
+    asyncio.run(transfer(sys.argv[2], sys.argv[1], list(zip(files[::2], files[1::2]))))
@@ -2,7 +2,9 @@
 
 from urllib.parse import urlparse
 import socket
+import select
 import struct
+import threading
 import os
 import sys
 
@@ -22,6 +24,11 @@ DCAP_SEEK_SET = 0
 DCAP_SEEK_CUR = 1
 DCAP_SEEK_END = 2
 
+CONTROL_BUFFER_SIZE = 4096
+SEND_BUFFER_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+
 
 def _merge_string(b):
     r = ''
@@ -30,6 +37,35 @@ def _merge_string(b):
     return r
 
 
+class ControlReply:
+    """A line received on the control connection: <seq> <sub seq> <origin> <command> [<arg> ...]"""
+
+    def __init__(self, line):
+        s = line.split()
+        if len(s) < 4:
+            raise RuntimeError("malformed control message: " + line)
+        self.seq = int(s[0])
+        self.sub_seq = int(s[1])
+        self.origin = s[2]
+        self.command = s[3]
+        self.args = s[4:]
+        self.line = line
+
+    def __repr__(self):
+        return "ControlReply(%r)" % self.line
+
+    def failed(self):
+        return self.command == 'failed'
+
+    def option(self, key):
+        # the value of a -<key>=<value> argument, None if the reply has none
+        for arg in self.args:
+            name, _, value = arg.partition('=')
+            if name == '-' + key:
+                return value
+        return None
+
+
 class Dcap:
     """dCache Client Access Protocol DCAP"""
 
@@ -39,6 +75,12 @@ class Dcap:
         self.port = u.port
         self.root = u.path
         self.seq = 0
+        self._buffer = bytearray()
+        self._replies = {}
+        # the control connection is shared by all streams opened on it, which may be used from several threads
+        self._lock = threading.RLock()
+        self.streams = {}
+        self.broken = False
         self._connect()
         self._send_hello()
 
@@ -56,50 +98,97 @@ class Dcap:
         self.socket.close()
 
     def _rcv_control_msg(self):
-        msg = ''
+        # bytes behind the newline belong to the next message and stay in the buffer
+        start = 0
         while True:
-            chunk = self.socket.recv(1).decode('utf-8')
-            if chunk == '':
-                raise RuntimeError("socket connection broken")
-            if chunk == '\n':
+            end = self._buffer.find(b'\n', start)
+            if end >= 0:
                 break
-            msg = msg + chunk
+            start = len(self._buffer)
+            try:
+                chunk = self.socket.recv(CONTROL_BUFFER_SIZE)
+            except OSError:
+                self.broken = True
+                raise
+            if len(chunk) == 0:
+                self.broken = True
+                raise RuntimeError("socket connection broken")
+            self._buffer.extend(chunk)
+        msg = self._buffer[:end].decode('utf-8')
+        del self._buffer[:end + 1]
         return msg
 
+    def _rcv_reply(self, seq):
+        # replies to other requests, e.g. the close of another stream, are kept until they are asked for
+        reply = self._replies.pop(seq, None)
+        while reply is None:
+            reply = ControlReply(self._rcv_control_msg())
+            if reply.seq != seq:
+                self._replies[reply.seq] = reply
+                reply = None
+        return reply
+
     def _send_control_msg(self, msg):
         cmsg = msg + '\n'
-        sent = self.socket.sendall(cmsg.encode('utf-8'))
-
-        if sent == 0:
-            raise RuntimeError("socket connection broken")
+        try:
+            self.socket.sendall(cmsg.encode('utf-8'))
+        except OSError:
+            self.broken = True
+            raise
         self.seq += 1
 
+    def _request(self, fmt, *args):
+        # sends a command with the next sequence number and waits for its reply; fmt starts with the %d for it
+        with self._lock:
+            seq = self.seq
+            self._send_control_msg(fmt % ((seq,) + args))
+            return seq, self._rcv_reply(seq)
+
+    def is_alive(self):
+        if self.broken:
+            return False
+        with self._lock:
+            try:
+                # an idle control connection has nothing to read, unless the door has closed it
+                readable, _, _ = select.select([self.socket], [], [], 0)
+                if readable and len(self.socket.recv(1, socket.MSG_PEEK)) == 0:
+                    self.broken = True
+            except OSError:
+                self.broken = True
+        return not self.broken
+
     def _send_hello(self):
-        hello = "%d 0 client hello %d %d %d %d" % (self.seq, VER_MAJ, VER_MIN, VER_MAJ, VER_MIN)
-        self._send_control_msg(hello)
-        reply = self._rcv_control_msg()
+        _, reply = self._request("%d 0 client hello %d %d %d %d", VER_MAJ, VER_MIN, VER_MAJ, VER_MIN)
+        if reply.failed():
+            raise RuntimeError("door refused hello: " + _merge_string(reply.args))
 
     def _send_bye(self):
-        bye = "%d 0 client byebye" % (self.seq)
-        self._send_control_msg(bye)
-        reply = self._rcv_control_msg()
-
-    def open_file(self, path, mode='r'):
-        session = self.seq
-        open_opemmand = "%d 0 client open \"dcap://%s:%d/%s/%s\" %s localhost 1111 -passive -uid=%d -gid=%d -mode=0644" % \
-                        (self.seq, self.host, self.port, self.root, path, mode, os.getuid(), os.getgid())
-        self._send_control_msg(open_opemmand)
-        reply = self._rcv_control_msg()
+        self._request("%d 0 client byebye")
+
+    def open_file(self, path, mode='r', buffer_size=WRITE_BUFFER_SIZE, uid=None, gid=None, file_mode=0o644):
+        # uid, gid and file_mode are those of a file created by the open, by default the caller's and 0644
+        if '/' in path:
+            target = "\"dcap://%s:%d/%s/%s\"" % (self.host, self.port, self.root, path)
+        else:
+            # a pnfsid, e.g. of an archive
+            target = path
+        # the sequence number of the open identifies the stream's session, also in the reply to its close
+        session, reply = self._request("%d 0 client open %s %s localhost 1111 -passive -uid=%d -gid=%d -mode=0%o",
+                                       target, mode, os.getuid() if uid is None else uid,
+                                       os.getgid() if gid is None else gid, file_mode)
         host, port, chalange = self.parse_reply(reply, path)
 
         data_socket = self._init_data_connection(session, host, port, chalange)
-        return DcapStream(data_socket, self)
+        stream = DcapStream(data_socket, self, session, buffer_size)
+        # doors that report the pnfsid of the opened file add it as -pnfsid=<id>
+        stream.pnfsid = reply.option('pnfsid')
+        self.streams[session] = stream
+        return stream
 
     def parse_reply(self, reply, path):
-        s = reply.split()
-        if s[3] == 'failed':
-            raise RuntimeError("failed to open file " + path + ": " + _merge_string(s[5:]))
-        return s[4], int(s[5]), s[6]
+        if reply.failed():
+            raise RuntimeError("failed to open file " + path + ": " + _merge_string(reply.args[1:]))
+        return reply.args[0], int(reply.args[1]), reply.args[2]
 
     def _init_data_connection(self, session, host, port, chalange):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -112,31 +201,111 @@ class Dcap:
         return s
 
     def rename(self, src, dest):
-        rename_cmd = "%d 0 client rename dcap://%s:%d/%s/%s %s" % \
-                     (self.seq, self.host, self.port, self.root, src, dest)
-        self._send_control_msg(rename_cmd)
-        reply = self._rcv_control_msg()
+        _, reply = self._request("%d 0 client rename dcap://%s:%d/%s/%s %s", self.host, self.port, self.root, src, dest)
+        if reply.failed():
+            raise RuntimeError("failed to rename " + src + ": " + _merge_string(reply.args[1:]))
 
     def close(self):
         self._send_bye()
         self._close()
 
 
-def readFully(s, count):
-    n = count
-    data = bytearray()
-    while n > 0:
-        d = s.recv(n)
-        n = n - len(d)
-        data.extend(d)
-    return data
+class DcapPool:
+    """Warm control connections to one door. Files are opened on the connection with the fewest open streams, up
+    to max_streams per connection, and new connections are made up to max_connections. Connections the door has
+    closed are dropped and replaced."""
+
+    def __init__(self, url, max_connections=1, max_streams=8):
+        self.url = url
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _connection(self):
+        with self._lock:
+            self.connections = [dcap for dcap in self.connections if dcap.is_alive()]
+            if self.connections:
+                dcap = min(self.connections, key=lambda d: len(d.streams))
+                if len(dcap.streams) < self.max_streams or len(self.connections) >= self.max_connections:
+                    return dcap
+            dcap = Dcap(self.url)
+            self.connections.append(dcap)
+            return dcap
+
+    def _discard(self, dcap):
+        with self._lock:
+            if dcap in self.connections:
+                self.connections.remove(dcap)
+        try:
+            dcap._close()
+        except OSError:
+            pass
+
+    def open_file(self, path, mode='r', buffer_size=WRITE_BUFFER_SIZE, uid=None, gid=None, file_mode=0o644):
+        dcap = self._connection()
+        try:
+            return dcap.open_file(path, mode, buffer_size, uid, gid, file_mode)
+        except (OSError, RuntimeError):
+            if not dcap.broken:
+                raise
+            self._discard(dcap)
+        # the connection broke under the request, e.g. after a restart of the door; one retry on a new one
+        return self._connection().open_file(path, mode, buffer_size, uid, gid, file_mode)
+
+    def rename(self, src, dest):
+        dcap = self._connection()
+        try:
+            return dcap.rename(src, dest)
+        except (OSError, RuntimeError):
+            if not dcap.broken:
+                raise
+            self._discard(dcap)
+        return self._connection().rename(src, dest)
+
+    def close(self):
+        with self._lock:
+            connections, self.connections = self.connections, []
+        for dcap in connections:
+            try:
+                if not dcap.broken:
+                    dcap.close()
+                else:
+                    dcap._close()
+            except (OSError, RuntimeError):
+                pass
+
+
+def readFullyInto(s, view):
+    while len(view) > 0:
+        n = s.recv_into(view)
+        if n == 0:
+            raise RuntimeError("socket connection broken")
+        view = view[n:]
 
 
 class DcapStream:
 
-    def __init__(self, sock, dcap):
+    def __init__(self, sock, dcap, session, buffer_size=WRITE_BUFFER_SIZE):
         self.socket = sock
         self.dcap = dcap
+        self.session = session
+        self.pnfsid = None
+        self._send_buffer = None
+        self._read_buffer = None
+        self.closed = False
+        # writes are collected in _write_buffer and sent as DATA blocks of one DCAP_WRITE that stays open until
+        # the next command on the stream; the position is tracked here so that tell() needs no round trip
+        self.buffer_size = buffer_size
+        self._write_buffer = bytearray()
+        self._writing = False
+        self.position = 0
 
     def __enter__(self):
         return self
@@ -146,75 +315,127 @@ class DcapStream:
 
     def _get_ack(self):
         unpacker = struct.Struct('>I')
-        msg = self.socket.recv(unpacker.size)
-        size = unpacker.unpack(msg)[0]
-        msg = self.socket.recv(size)
+        header = bytearray(unpacker.size)
+        readFullyInto(self.socket, memoryview(header))
+        msg = bytearray(unpacker.unpack(header)[0])
+        readFullyInto(self.socket, memoryview(msg))
         return msg
 
-    def _get_data(self):
-        unpacker = struct.Struct('>II')
-        msg = self.socket.recv(unpacker.size)
+    def _get_data_into(self, view):
+        # the blocks following the DATA header are received straight into view; returns the number of bytes received
+        header = bytearray(8)
+        readFullyInto(self.socket, memoryview(header))
 
         data_unpacker = struct.Struct('>I')
-        data = bytearray()
+        data_header = memoryview(header)[:data_unpacker.size]
+        received = 0
         while True:
-            data_header = self.socket.recv(data_unpacker.size)
+            readFullyInto(self.socket, data_header)
             count = data_unpacker.unpack(data_header)[0]
 
             if count == END_OF_DATA:
                 self._get_ack()
                 break
-            data.extend(readFully(self.socket, count))
-        return data
+            if received + count > len(view):
+                raise RuntimeError("door sent %d bytes more than requested" % (received + count - len(view)))
+            readFullyInto(self.socket, view[received:received + count])
+            received += count
+        return received
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if len(view) == 0:
+            return 0
+        self._end_write()
+        packer = struct.Struct('>IIq')
+        msg = packer.pack(12, DCAP_READ, len(view))
+        self.socket.sendall(msg)
+        self._get_ack()
+        n = self._get_data_into(view)
+        self.position += n
+        return n
 
     def read(self, count=-1):
 
         if count == -1:
             data = bytearray()
+            buffer = self._get_read_buffer()
             while True:
-                d = self.read(1024 * 1024)
-                if len(d) == 0:
-                    break;
-                data.extend(d)
+                n = self.readinto(buffer)
+                if n == 0:
+                    break
+                data.extend(buffer[:n])
             return data
 
-        packer = struct.Struct('>IIq')
-        msg = packer.pack(12, DCAP_READ, count)
-        self.socket.sendall(msg)
-        self._get_ack()
-        return self._get_data()
+        data = bytearray(count)
+        n = self.readinto(data)
+        del data[n:]
+        return data
+
+    def readall(self):
+        # io.BufferedReader expects bytes here
+        return bytes(self.read(-1))
+
+    def _get_read_buffer(self):
+        # reused by read(-1) and recv_file
+        if self._read_buffer is None:
+            self._read_buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        return self._read_buffer
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
 
     def seek(self, offset, from_what=0):
+        self._end_write()
         packer = struct.Struct('>IIqI')
         msg = packer.pack(16, DCAP_SEEK, offset, from_what);
         self.socket.sendall(msg)
         cb = self._get_ack()
         unpacker = struct.Struct('>IIIq')
-        return unpacker.unpack(cb)[3]
+        self.position = unpacker.unpack(cb)[3]
+        return self.position
 
     def tell(self):
-        return self.seek(0, DCAP_SEEK_CUR)
+        return self.position
 
     def flush(self):
-        pass
+        if self._write_buffer:
+            self._send_block(self._write_buffer)
+            self._write_buffer.clear()
 
     def parse_reply(self, reply):
-        s = reply.split()
-        if s[3] == 'failed':
-            raise RuntimeError("failed to close file: " + _merge_string(s[4:]))
+        if reply.failed():
+            raise RuntimeError("failed to close file: " + _merge_string(reply.args))
 
     def close(self):
+        if self.closed:
+            return
         packer = struct.Struct('>II')
 
-        msg = packer.pack(4, DCAP_CLOSE)
-        self.socket.sendall(msg)
-        self._get_ack()
-        reply = self.dcap._rcv_control_msg()
-        self.socket.close()
+        try:
+            self._end_write()
+            msg = packer.pack(4, DCAP_CLOSE)
+            self.socket.sendall(msg)
+            self._get_ack()
+            with self.dcap._lock:
+                reply = self.dcap._rcv_reply(self.session)
+        finally:
+            # a stream whose close failed is of no use either and must not count against the connection
+            with self.dcap._lock:
+                self.dcap.streams.pop(self.session, None)
+            self.socket.close()
+            self.closed = True
         self.parse_reply(reply)
 
     def send_file(self, src):
 
+        self._end_write()
         statinfo = os.stat(src)
         packer = struct.Struct('>II')
         msg = packer.pack(4, DCAP_WRITE)
@@ -226,65 +447,112 @@ class DcapStream:
         self.socket.sendall(data_header)
 
         with open(src, 'rb') as f:
-            while True:
-                data = f.read(256 * 1024)
-                if len(data) == 0:
-                    break
-                self.socket.sendall(data)
+            # the DATA header announces the size, so the kernel can copy the file straight to the socket
+            if hasattr(os, 'sendfile'):
+                sent = self.socket.sendfile(f, 0, statinfo.st_size)
+            else:
+                sent = self._send_buffered(f, statinfo.st_size)
+        if sent != statinfo.st_size:
+            raise RuntimeError("%s changed size during upload: sent %d of %d bytes" % (src, sent, statinfo.st_size))
+        self.position += sent
 
         data_packer = struct.Struct('>I')
         data_header = data_packer.pack(END_OF_DATA)
         self.socket.sendall(data_header)
         self._get_ack()
 
+    def _send_buffered(self, f, count):
+        if self._send_buffer is None:
+            self._send_buffer = bytearray(SEND_BUFFER_SIZE)
+        view = memoryview(self._send_buffer)
+        sent = 0
+        while sent < count:
+            n = f.readinto(view[:min(len(view), count - sent)])
+            if n == 0:
+                break
+            self.socket.sendall(view[:n])
+            sent += n
+        return sent
+
     def recv_file(self, dst):
 
+        buffer = self._get_read_buffer()
         with open(dst, 'wb') as f:
             while True:
-                data = self.read(1024 * 1024)
-                if len(data) == 0:
+                n = self.readinto(buffer)
+                if n == 0:
                     break
-                f.write(data)
+                f.write(buffer[:n])
 
-    def write(self, buf):
+    def sync(self):
+        # ends the running DCAP_WRITE, once it is acknowledged the mover has all data written so far
+        self._end_write()
+
+    def _start_write(self):
+        if self._writing:
+            return
         packer = struct.Struct('>II')
         msg = packer.pack(4, DCAP_WRITE)
         self.socket.sendall(msg)
         self._get_ack()
 
-        data_packer = struct.Struct('>III')
-        data_header = data_packer.pack(4, DATA, len(buf))
-        self.socket.sendall(data_header)
+        self.socket.sendall(packer.pack(4, DATA))
+        self._writing = True
+
+    def _send_block(self, buf):
+        data_packer = struct.Struct('>I')
+        self.socket.sendall(data_packer.pack(len(buf)))
         self.socket.sendall(buf)
+
+    def _end_write(self):
+        if not self._writing:
+            return
+        self.flush()
         data_packer = struct.Struct('>I')
         data_header = data_packer.pack(END_OF_DATA)
         self.socket.sendall(data_header)
+        self._writing = False
         self._get_ack()
 
+    def write(self, buf):
+        count = len(buf)
+        if count == 0:
+            return 0
+        self._start_write()
+        if len(self._write_buffer) + count > self.buffer_size:
+            self.flush()
+        if count >= self.buffer_size:
+            self._send_block(buf)
+        else:
+            self._write_buffer.extend(buf)
+        self.position += count
+        return count
+
     def readv(self, iovecs):
-        n = 8 + len(iovecs) * 12
+        """Reads a list of (offset, length) ranges with one request. Returns a memoryview for each range, all of
+        them slices of one buffer."""
+        self._end_write()
+        iovec_packer = struct.Struct('>QI')
         packer = struct.Struct('>III')
-        msg = packer.pack(n, DCAP_READV, len(iovecs))
-        self.socket.sendall(msg)
-
-        totalToRead = 0
-        data_packer = struct.Struct('>QI')
+        msg = bytearray(packer.pack(8 + len(iovecs) * iovec_packer.size, DCAP_READV, len(iovecs)))
+        total = 0
         for o, l in iovecs:
-            totalToRead = totalToRead + l
-            chunk = data_packer.pack(o, l)
-            self.socket.sendall(chunk)
-            self._get_ack()
-
-        data = ''
-        data_unpacker = struct.Struct('>I')
-        while totalToRead > 0:
-            data_header = self.socket.recv(data_unpacker.size)
-            count = data_unpacker.unpack(data_header)[0]
-            print("reading %d bytes" % count)
-            data = data + readFully(self.socket, count)
-            totalToRead = totalToRead - count
+            msg.extend(iovec_packer.pack(o, l))
+            total += l
+        self.socket.sendall(msg)
         self._get_ack()
-        return data
+
+        data = memoryview(bytearray(total))
+        received = self._get_data_into(data)
+        if received != total:
+            raise RuntimeError("readv returned %d of %d bytes" % (received, total))
+
+        slices = []
+        start = 0
+        for _, l in iovecs:
+            slices.append(data[start:start + l])
+            start += l
+        return slices
 
 
 def usage_and_exit():
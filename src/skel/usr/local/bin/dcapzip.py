@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Reads single members out of zip containers through a DcapStream. Only the end of the archive, its central
+# directory and the member's local header and data are read, never the whole container.
+#
+# Containers may also be written in the indexed format of pack-files.py instead of zip. There each member is an
+# INDEXED_MEMBER header, the member's name and its data. The index follows the last member, one fixed-width
+# INDEXED_ENTRY per member, and the INDEXED_TRAILER at the very end of the file locates it. db.archive_index holds
+# the same entries, so a restore seeks straight to the member.
+
+import sys
+import zlib
+import lzma
+import struct
+from zipfile import BadZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, _get_decompressor
+from dcap import Dcap, DCAP_SEEK_END
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+END_OF_CENTRAL_DIR_SIG = b'PK\x05\x06'
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LOCATOR_SIG = b'PK\x06\x07'
+ZIP64_END_OF_CENTRAL_DIR = struct.Struct('<4sQ2H2L4Q')
+ZIP64_END_OF_CENTRAL_DIR_SIG = b'PK\x06\x06'
+CENTRAL_DIR_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+CENTRAL_DIR_HEADER_SIG = b'PK\x01\x02'
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIG = b'PK\x03\x04'
+INDEXED_MEMBER = struct.Struct('<4s2H')
+INDEXED_MEMBER_SIG = b'SFCM'
+INDEXED_ENTRY = struct.Struct('<36s3QLH')
+INDEXED_NAME_SIZE = 36
+INDEXED_TRAILER = struct.Struct('<4s2H2QL')
+INDEXED_TRAILER_SIG = b'SFCI'
+INDEXED_VERSION = 1
+ZIP64_EXTRA = 0x0001
+MAX_COMMENT = 0xffff
+CHUNK_SIZE = 1024 * 1024
+# method id of zstd in the zip format, zipfile itself can't write or read it before Python 3.14
+ZIP_ZSTANDARD = 93
+ZSTANDARD_VERSION = 63
+# what reading a damaged or unsupported member raises; bz2 reports bad data as OSError
+MEMBER_ERRORS = (BadZipFile, NotImplementedError, zlib.error, lzma.LZMAError, OSError) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class Member:
+
+    def __init__(self, name, header_offset, compress_size, file_size, crc, compress_type):
+        self.name = name
+        self.header_offset = header_offset
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.crc = crc
+        self.compress_type = compress_type
+
+    def __repr__(self):
+        return f"Member({self.name}, offset={self.header_offset}, size={self.compress_size})"
+
+    @classmethod
+    def from_index(cls, entry):
+        # an entry of db.archive_index, as written by pack-files.py
+        return cls(entry['pnfsid'], entry['offset'], entry['compressSize'], entry['fileSize'], entry['crc'],
+                   entry['compressType'])
+
+
+def _read_at(stream, offset, count):
+    stream.seek(offset)
+    data = stream.read(count)
+    if len(data) != count:
+        raise BadZipFile(f"Archive truncated: read {len(data)} of {count} bytes at offset {offset}")
+    return data
+
+
+def _read_tail(stream):
+    size = stream.seek(0, DCAP_SEEK_END)
+    tail_size = min(size, END_OF_CENTRAL_DIR.size + MAX_COMMENT + ZIP64_LOCATOR.size)
+    tail_offset = size - tail_size
+    return tail_offset, _read_at(stream, tail_offset, tail_size)
+
+
+def _central_directory_location(stream, tail_offset, tail):
+    pos = tail.rfind(END_OF_CENTRAL_DIR_SIG)
+    if pos < 0:
+        raise BadZipFile("End of central directory not found")
+    _, _, _, _, entries, cd_size, cd_offset, _ = END_OF_CENTRAL_DIR.unpack_from(tail, pos)
+
+    if entries == 0xffff or cd_size == 0xffffffff or cd_offset == 0xffffffff:
+        locator_pos = pos - ZIP64_LOCATOR.size
+        if locator_pos < 0:
+            raise BadZipFile("Zip64 end of central directory locator not found")
+        signature, _, eocd64_offset, _ = ZIP64_LOCATOR.unpack_from(tail, locator_pos)
+        if signature != ZIP64_LOCATOR_SIG:
+            raise BadZipFile("Zip64 end of central directory locator not found")
+        eocd64 = _read_at(stream, eocd64_offset, ZIP64_END_OF_CENTRAL_DIR.size)
+        signature, _, _, _, _, _, _, entries, cd_size, cd_offset = ZIP64_END_OF_CENTRAL_DIR.unpack(eocd64)
+        if signature != ZIP64_END_OF_CENTRAL_DIR_SIG:
+            raise BadZipFile("Zip64 end of central directory not found")
+
+    return cd_offset, cd_size
+
+
+def _zip64_values(extra, values):
+    # values holds file size, compress size and header offset; the ones set to 0xffffffff are in the zip64 extra
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from('<2H', extra, pos)
+        if tag == ZIP64_EXTRA:
+            field = pos + 4
+            for i, value in enumerate(values):
+                if value == 0xffffffff:
+                    values[i] = struct.unpack_from('<Q', extra, field)[0]
+                    field += 8
+            break
+        pos += 4 + length
+    return values
+
+
+def _index_location(tail):
+    # (entries, offset, crc) of the index if tail is the end of an indexed container, None if not
+    if len(tail) < INDEXED_TRAILER.size:
+        return None
+    signature, version, _, entries, offset, crc = INDEXED_TRAILER.unpack_from(tail, len(tail) - INDEXED_TRAILER.size)
+    if signature != INDEXED_TRAILER_SIG:
+        return None
+    if version != INDEXED_VERSION:
+        raise BadZipFile(f"Unsupported version {version} of the indexed container format")
+    return entries, offset, crc
+
+
+def parse_index(index, crc):
+    if zlib.crc32(index) != crc:
+        raise BadZipFile("Bad CRC-32 for the container index")
+    for name, offset, compress_size, file_size, member_crc, compress_type in INDEXED_ENTRY.iter_unpack(index):
+        yield Member(name.rstrip(b'\0').decode('utf-8'), offset, compress_size, file_size, member_crc, compress_type)
+
+
+def index_members(buffer):
+    """Lists the members of an indexed container held in buffer, e.g. a memory-mapped local file."""
+    location = _index_location(buffer[len(buffer) - INDEXED_TRAILER.size:])
+    if location is None:
+        raise BadZipFile("Not an indexed container")
+    entries, offset, crc = location
+    return list(parse_index(buffer[offset:offset + entries * INDEXED_ENTRY.size], crc))
+
+
+def iter_members(stream):
+    tail_offset, tail = _read_tail(stream)
+    location = _index_location(tail)
+    if location is not None:
+        entries, offset, crc = location
+        if offset >= tail_offset:
+            index = tail[offset - tail_offset:offset - tail_offset + entries * INDEXED_ENTRY.size]
+        else:
+            index = _read_at(stream, offset, entries * INDEXED_ENTRY.size)
+        yield from parse_index(index, crc)
+        return
+
+    cd_offset, cd_size = _central_directory_location(stream, tail_offset, tail)
+    if cd_offset >= tail_offset:
+        central_dir = tail[cd_offset - tail_offset:cd_offset - tail_offset + cd_size]
+    else:
+        central_dir = _read_at(stream, cd_offset, cd_size)
+
+    pos = 0
+    while pos + CENTRAL_DIR_HEADER.size <= len(central_dir):
+        header = CENTRAL_DIR_HEADER.unpack_from(central_dir, pos)
+        if header[0] != CENTRAL_DIR_HEADER_SIG:
+            raise BadZipFile(f"Bad central directory entry at offset {cd_offset + pos}")
+        compress_type, crc, compress_size, file_size = header[6], header[9], header[10], header[11]
+        name_length, extra_length, comment_length, header_offset = header[12], header[13], header[14], header[18]
+        name_start = pos + CENTRAL_DIR_HEADER.size
+        name = bytes(central_dir[name_start:name_start + name_length]).decode('utf-8')
+        extra = central_dir[name_start + name_length:name_start + name_length + extra_length]
+        file_size, compress_size, header_offset = _zip64_values(extra, [file_size, compress_size, header_offset])
+        yield Member(name, header_offset, compress_size, file_size, crc, compress_type)
+        pos = name_start + name_length + extra_length + comment_length
+
+
+def locate_member(stream, name):
+    for member in iter_members(stream):
+        if member.name == name:
+            return member
+    raise KeyError(f"There is no item named {name} in the archive")
+
+
+def _decompressor(compress_type):
+    if compress_type == ZIP_STORED:
+        return None
+    if compress_type in (ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA):
+        return _get_decompressor(compress_type)
+    if compress_type == ZIP_ZSTANDARD:
+        if zstandard is None:
+            raise NotImplementedError("Member is compressed with zstd, but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise NotImplementedError(f"Compression method {compress_type} not supported")
+
+
+class SequentialReader:
+    """Reads forward through a stream in large chunks. Gaps of up to max_gap bytes between the requested ranges are
+    read through rather than seeked over, so that members stored next to each other come in one streaming read."""
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE, max_gap=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_gap = max_gap
+        self.offset = None
+        self.buffer = memoryview(b'')
+        self.chunk = bytearray(chunk_size)
+
+    def goto(self, offset):
+        if self.offset is not None and self.offset <= offset <= self.offset + len(self.buffer) + self.max_gap:
+            skip = offset - self.offset
+            while skip > 0:
+                skipped = len(self._fill(skip))
+                if skipped == 0:
+                    raise BadZipFile(f"Archive truncated before offset {offset}")
+                skip -= skipped
+        else:
+            self.stream.seek(offset)
+            self.offset = offset
+            self.buffer = memoryview(b'')
+
+    def _fill(self, count):
+        if len(self.buffer) == 0:
+            # the chunk is reused, callers copy what they keep before the next fill
+            self.buffer = memoryview(self.chunk)[:self.stream.readinto(self.chunk)]
+        data = self.buffer[:count]
+        self.buffer = self.buffer[len(data):]
+        self.offset += len(data)
+        return data
+
+    def read(self, count):
+        data = self._fill(count)
+        if len(data) == count or len(data) == 0:
+            return bytes(data)
+        parts = [bytes(data)]
+        count -= len(data)
+        while count > 0:
+            data = self._fill(count)
+            if len(data) == 0:
+                break
+            parts.append(bytes(data))
+            count -= len(data)
+        return b''.join(parts)
+
+
+def _read_header(read, layout, signature, member):
+    header = signature + read(layout.size - len(signature))
+    if len(header) != layout.size:
+        raise BadZipFile(f"Archive truncated at local header of {member.name}")
+    return layout.unpack(header)
+
+
+def _copy_member(read, member, out):
+    # read() is positioned at the member's local header, or its INDEXED_MEMBER header in an indexed container
+    signature = read(4)
+    if signature == LOCAL_HEADER_SIG:
+        header = _read_header(read, LOCAL_HEADER, signature, member)
+        # name and extra field are read along with the data
+        skip = header[10] + header[11]
+    elif signature == INDEXED_MEMBER_SIG:
+        header = _read_header(read, INDEXED_MEMBER, signature, member)
+        skip = header[1]
+    else:
+        raise BadZipFile(f"Bad local header for {member.name} at offset {member.header_offset}")
+
+    remaining = skip + member.compress_size
+    decompressor = _decompressor(member.compress_type)
+    crc = 0
+    while remaining > 0:
+        data = read(min(CHUNK_SIZE, remaining))
+        if len(data) == 0:
+            raise BadZipFile(f"Archive truncated while reading {member.name}")
+        remaining -= len(data)
+        if skip:
+            skipped = min(skip, len(data))
+            data = data[skipped:]
+            skip -= skipped
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        crc = zlib.crc32(data, crc)
+        out.write(data)
+
+    # the bzip2 and lzma decompressors have nothing left to flush
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        crc = zlib.crc32(data, crc)
+        out.write(data)
+
+    if crc != member.crc:
+        raise BadZipFile(f"Bad CRC-32 for {member.name}")
+
+
+def read_member(stream, member, out):
+    stream.seek(member.header_offset)
+    _copy_member(stream.read, member, out)
+
+
+def extract_member(stream, name, dst, member=None):
+    if member is None:
+        member = locate_member(stream, name)
+    with open(dst, 'wb') as out:
+        read_member(stream, member, out)
+    return member
+
+
+def extract_members(stream, targets):
+    """Extracts (member, dst) pairs in the order of their offsets in the archive. Yields (member, dst, error) for
+    each of them, error being None if the member was extracted."""
+    reader = SequentialReader(stream)
+    for member, dst in sorted(targets, key=lambda target: target[0].header_offset):
+        try:
+            reader.goto(member.header_offset)
+            with open(dst, 'wb') as out:
+                _copy_member(reader.read, member, out)
+        except MEMBER_ERRORS as e:
+            yield member, dst, e
+        else:
+            yield member, dst, None
+
+
+class _Discard:
+
+    def write(self, data):
+        pass
+
+
+def verify_members(stream, members):
+    """Reads the given members in the order of their offsets and checks their CRC-32. Yields (member, error) for
+    each of them, error being None if the member is intact."""
+    reader = SequentialReader(stream)
+    discard = _Discard()
+    for member in sorted(members, key=lambda m: m.header_offset):
+        try:
+            reader.goto(member.header_offset)
+            _copy_member(reader.read, member, discard)
+        except MEMBER_ERRORS as e:
+            yield member, e
+        else:
+            yield member, None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print("Usage: dcapzip.py <door> <archive> <member> <local file>")
+        sys.exit(1)
+
+    with Dcap(sys.argv[1]) as dcap:
+        with dcap.open_file(sys.argv[2], 'r') as f:
+            extract_member(f, sys.argv[3], sys.argv[4])
@@ -6,7 +6,9 @@ import sys
 import time
 import signal
 import configparser as parser
-from pymongo import MongoClient, errors
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, UpdateOne, DeleteOne, errors
+import sfdb
 import logging
 import logging.handlers
 
@@ -24,6 +26,11 @@ mongo_uri = "mongodb://localhost/"
 mongo_db = "smallfiles"
 mount_point = ""
 data_root = ""
+metadata_workers = 16
+db_batch_size = 1000
+change_streams = True
+# what the server answers to $changeStream if it doesn't support change streams, e.g. if it is no replica set member
+CHANGE_STREAMS_UNSUPPORTED = {40324, 40573}
 
 
 def read_dotfile(filepath, tag):
@@ -33,6 +40,95 @@ def read_dotfile(filepath, tag):
     return result
 
 
+def resolve_metadata(record):
+    # runs in the worker threads, the latency of the NFS door is the limit here
+    try:
+        pathof = read_dotfile(os.path.join(mount_point, record['pnfsid']), 'pathof')
+        localpath = pathof.replace(data_root, mount_point, 1)
+        stats = os.stat(localpath)
+        return record, {'path': pathof, 'parent': os.path.dirname(pathof), 'size': stats.st_size,
+                        'ctime': stats.st_ctime, 'status': 'new'}, None
+    except (KeyError, OSError) as e:
+        return record, None, e
+
+
+class Throughput:
+    """Counts the records filled and the time spent resolving and writing them. The time the change stream waits for
+    inserts is not included."""
+
+    def __init__(self):
+        self.files = 0
+        self.seconds = 0.0
+
+
+def fill_batch(db, executor, records, throughput):
+    start = time.time()
+    requests = []
+    for record, metadata, error in executor.map(resolve_metadata, records):
+        if isinstance(error, KeyError):
+            logging.warning(f"KeyError: {str(record)}: {str(error)}")
+        elif error is not None:
+            logging.warning(f"{type(error).__name__}: {str(record)}: {str(error)}")
+            logging.info(f"Removing entry for file {record['pnfsid']}")
+            requests.append(DeleteOne({'pnfsid': record['pnfsid'], 'status': {'$exists': False}}))
+        else:
+            # a record may come from both the catch-up poll and the change stream; once filled it belongs to the
+            # packer and must not be set back to new
+            requests.append(UpdateOne({'_id': record['_id'], 'status': {'$exists': False}}, {'$set': metadata}))
+            logging.debug(f"Updating record {record['pnfsid']}: {str(metadata)}")
+
+    if requests:
+        db.files.bulk_write(requests, ordered=False)
+    throughput.files += len(records)
+    throughput.seconds += time.time() - start
+
+
+def poll_new_files(db, executor, throughput):
+    with db.files.find({'status': {'$exists': False}}, {'pnfsid': True}).batch_size(db_batch_size) as cursor:
+        records = []
+        for record in cursor:
+            if not running:
+                sys.exit(1)
+            records.append(record)
+            if len(records) >= db_batch_size:
+                fill_batch(db, executor, records, throughput)
+                records = []
+        if records:
+            fill_batch(db, executor, records, throughput)
+
+
+def watch_new_files(db, executor, watch_time, throughput):
+    # Records inserted by datasetPut.js are picked up as they arrive. The stream is opened before polling once, so
+    # nothing inserted in between is missed. Events are collected until a batch is full or the stream is idle.
+    # Returns False if the server doesn't support change streams.
+    global change_streams
+    deadline = time.time() + watch_time
+    try:
+        stream = db.files.watch([{'$match': {'operationType': 'insert'}}], max_await_time_ms=1000)
+    except errors.OperationFailure as e:
+        if e.code not in CHANGE_STREAMS_UNSUPPORTED:
+            raise
+        logging.warning(f"Could not watch for inserts, falling back to polling: {str(e)}")
+        change_streams = False
+        return False
+
+    with stream:
+        poll_new_files(db, executor, throughput)
+        records = []
+        while running and stream.alive and time.time() < deadline:
+            change = stream.try_next()
+            if change is not None:
+                records.append(change['fullDocument'])
+                if len(records) < db_batch_size:
+                    continue
+            if records:
+                fill_batch(db, executor, records, throughput)
+                records = []
+        if records:
+            fill_batch(db, executor, records, throughput)
+    return True
+
+
 def main(configfile='/etc/dcache/container.conf'):
     global running
 
@@ -45,7 +141,8 @@ def main(configfile='/etc/dcache/container.conf'):
             configuration = parser.RawConfigParser(
                 defaults={'scriptId': 'pack', 'archiveUser': 'root', 'archiveMode': '0644',
                           'mongoUri': 'mongodb://localhost/', 'mongoDb': 'smallfiles', 'loopDelay': 5,
-                          'logLevel': 'ERROR'})
+                          'logLevel': 'ERROR', 'metadataWorkers': 16, 'dbBatchSize': 1000,
+                          'watchInserts': 'yes', 'watchTime': 300})
             configuration.read(configfile)
             # if type(configuration) == FileNotFoundError:
             #     logging.error(f"Configuration file {configfile} not found.")
@@ -55,6 +152,8 @@ def main(configfile='/etc/dcache/container.conf'):
             global data_root
             global mongo_uri
             global mongo_db
+            global metadata_workers
+            global db_batch_size
 
             script_id = configuration.get('DEFAULT', 'scriptId')
 
@@ -76,42 +175,35 @@ def main(configfile='/etc/dcache/container.conf'):
             mongo_uri = configuration.get('DEFAULT', 'mongoUri')
             mongo_db = configuration.get('DEFAULT', 'mongodb')
             loop_delay = configuration.getint('DEFAULT', 'loopDelay')
+            metadata_workers = configuration.getint('DEFAULT', 'metadataWorkers')
+            db_batch_size = configuration.getint('DEFAULT', 'dbBatchSize')
+            watch_inserts = configuration.getboolean('DEFAULT', 'watchInserts')
+            watch_time = configuration.getint('DEFAULT', 'watchTime')
 
             logging.info(f'Successfully read configuration from file {configfile}.')
 
+            watching = False
             try:
                 client = MongoClient(mongo_uri)
                 db = client[mongo_db]
+                sfdb.prepare(db)
 
-                with db.files.find({'state': {'$exists': False}}, snapshot=True) as new_files_cursor:
-                    logging.info(f"found {new_files_cursor.count()} new files")
-                    for record in new_files_cursor:
-                        if not running:
-                            sys.exit(1)
+                throughput = Throughput()
+                with ThreadPoolExecutor(max_workers=metadata_workers) as executor:
+                    if watch_inserts and change_streams:
                         try:
-                            pathof = read_dotfile(os.path.join(mount_point, record['pnfsid']), 'pathof')
-                            localpath = pathof.replace(data_root, mount_point, 1)
-                            stats = os.stat(localpath)
-
-                            record['path'] = pathof
-                            record['parent'] = os.path.dirname(pathof)
-                            record['size'] = stats.st_size
-                            record['ctime'] = stats.st_ctime
-                            record['state'] = 'new'
-
-                            new_files_cursor.collection.save(record)
-                            logging.debug(f"Updated record: {str(record)}")
-                        except KeyError as e:
-                            logging.warning(f"KeyError: {str(record)}: {str(e)}")
-                        except IOError as e:
-                            logging.warning(f"IOError: {str(record)}: {str(e)}")
-                            logging.info(f"Removing entry for file {record['pnfsid']}")
-                            db.files.remove({'pnfsid': record['pnfsid']})
-                        except OSError as e:
-                            logging.warning(f"OSError: {str(record)}: {str(e)}")
-                            logging.exception(e)
-                            logging.info(f"Removing entry for file {record['pnfsid']}")
-                            db.files.remove({'pnfsid': record['pnfsid']})
+                            watching = watch_new_files(db, executor, watch_time, throughput)
+                        except errors.OperationFailure as e:
+                            # the stream is opened again in the next loop
+                            logging.warning(f"Watching for inserts failed, polling instead: {str(e)}")
+                    if not watching:
+                        poll_new_files(db, executor, throughput)
+
+                if throughput.files:
+                    logging.info(f"Filled metadata of {throughput.files} new files in {throughput.seconds:.2f} "
+                                 f"seconds ({throughput.files / throughput.seconds:.1f} files/s)")
+                else:
+                    logging.info("found no new files")
 
                 client.close()
 
@@ -120,8 +212,9 @@ def main(configfile='/etc/dcache/container.conf'):
             except errors.OperationFailure as e:
                 logging.warning(f"Could not create cursor: {str(e)}")
 
-            logging.info(f"Sleeping for {loop_delay} seconds")
-            time.sleep(loop_delay)
+            if not watching:
+                logging.info(f"Sleeping for {loop_delay} seconds")
+                time.sleep(loop_delay)
 
     except parser.NoOptionError as e:
         print(f"Missing option: {str(e)}")
@@ -10,11 +10,19 @@ import logging.handlers
 from datetime import datetime
 import re
 import configparser as parser
+import io
 import uuid
-from zipfile import ZipFile
-from pymongo import MongoClient, errors, ASCENDING
+import zlib
+import zipfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, ZIP64_LIMIT
+from pymongo import MongoClient, UpdateOne, errors, ASCENDING
 from pwd import getpwnam
-from dcap import Dcap
+from dcap import DcapPool, DCAP_SEEK_END
+import dcapzip
+import sfdb
 
 running = True
 
@@ -35,11 +43,181 @@ mongo_db = "smallfiles"
 mount_point = ""
 data_root = ""
 dcap_url = ""
+rw_size = 1048576
+dcap_pool = None
+db_batch_size = 1000
+prefetch_workers = 4
+prefetch_memory = 268435456
+copy_size = 1048576
+journal_interval = 1073741824
+# a member is compressed only if compressing its first compress_sample bytes saves at least compress_min_saving
+compress_sample = 65536
+compress_min_saving = 0.1
+
+COMPRESSION_METHODS = {'stored': ZIP_STORED, 'deflate': ZIP_DEFLATED, 'bzip2': ZIP_BZIP2, 'lzma': ZIP_LZMA,
+                       'zstd': dcapzip.ZIP_ZSTANDARD}
+# the fields of a candidate record that planning and packing use
+CANDIDATE_FIELDS = {'pnfsid': True, 'path': True, 'size': True, 'ctime': True}
+
+
+class ChecksumWriter:
+    """Passes writes on to the container's DcapStream and keeps the Adler32 of everything written, so that it can be
+    compared with the checksum dCache computes for the container. Does not seek, so ZipFile writes sequentially and
+    puts data descriptors behind the members it streams."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.adler32 = 1
+
+    def write(self, data):
+        self.adler32 = zlib.adler32(data, self.adler32)
+        return self.stream.write(data)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, offset, whence=0):
+        raise io.UnsupportedOperation("seek")
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        self.stream.flush()
+
+
+class ZipContainerWriter:
+    """Writes the members of a container into a zip file, the default container format."""
+
+    def __init__(self, stream, compression):
+        compress_type, compress_level = compression
+        if compress_type == dcapzip.ZIP_ZSTANDARD:
+            # zipfile can't write zstd, prefetched members are compressed by prepare_member, streamed ones stored
+            compress_type = ZIP_STORED
+        self.stream = stream
+        self.zipfile = ZipFile(stream, "w", compression=compress_type, compresslevel=compress_level)
+        self.filelist = self.zipfile.filelist
+        self.streamed_compression = (compress_type, compress_level)
+
+    def open(self, zinfo):
+        return self.zipfile.open(zinfo, 'w')
+
+    def write_prepared(self, zinfo, data):
+        # CRC and sizes are known up front, so the local header is complete and needs no data descriptor
+        if zinfo.compress_type != dcapzip.ZIP_ZSTANDARD:
+            # zipfile rejects zstd, which it can't compress itself; prepare_member has compressed the data already
+            self.zipfile._writecheck(zinfo)
+        zinfo.header_offset = self.zipfile.start_dir
+        self.stream.write(zinfo.FileHeader(zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT))
+        self.stream.write(data)
+        self.zipfile.start_dir = self.stream.tell()
+        self.filelist.append(zinfo)
+        self.zipfile.NameToInfo[zinfo.filename] = zinfo
+
+    def restore(self, zinfos):
+        for zinfo in zinfos:
+            self.filelist.append(zinfo)
+            self.zipfile.NameToInfo[zinfo.filename] = zinfo
+        self.zipfile.start_dir = self.stream.tell()
+
+    def discard(self, zinfo):
+        # ZipFile adds a member to the central directory when it is closed, even if writing its data failed. The bytes
+        # already sent can't be taken back, they stay in the container without a reference.
+        if self.filelist and self.filelist[-1] is zinfo:
+            self.filelist.pop()
+            self.zipfile.NameToInfo.pop(zinfo.filename, None)
+
+    def close(self):
+        self.zipfile.close()
+
+
+class IndexedContainerWriter:
+    """Writes the members of a container in the indexed format described in dcapzip.py. Each member costs a header
+    of eight bytes plus its name and an index entry, the index is written behind the last member on close."""
+
+    def __init__(self, stream, compression):
+        self.stream = stream
+        self.filelist = []
+        self.streamed_compression = compression
+
+    def _write_header(self, zinfo):
+        name = zinfo.filename.encode('utf-8')
+        if len(name) > dcapzip.INDEXED_NAME_SIZE:
+            raise ValueError(f"Member name {zinfo.filename} is longer than {dcapzip.INDEXED_NAME_SIZE} bytes")
+        zinfo.header_offset = self.stream.tell()
+        self.stream.write(dcapzip.INDEXED_MEMBER.pack(dcapzip.INDEXED_MEMBER_SIG, len(name), zinfo.compress_type))
+        self.stream.write(name)
+
+    def open(self, zinfo):
+        self._write_header(zinfo)
+        return IndexedMemberWriter(self, zinfo)
+
+    def write_prepared(self, zinfo, data):
+        self._write_header(zinfo)
+        self.stream.write(data)
+        self.filelist.append(zinfo)
+
+    def restore(self, zinfos):
+        self.filelist.extend(zinfos)
+
+    def discard(self, zinfo):
+        # IndexedMemberWriter leaves a failed member out of the index already, its bytes stay without a reference
+        if self.filelist and self.filelist[-1] is zinfo:
+            self.filelist.pop()
+
+    def close(self):
+        index = b''.join(dcapzip.INDEXED_ENTRY.pack(zinfo.filename.encode('utf-8'), zinfo.header_offset,
+                                                    zinfo.compress_size, zinfo.file_size, zinfo.CRC,
+                                                    zinfo.compress_type)
+                         for zinfo in self.filelist)
+        offset = self.stream.tell()
+        self.stream.write(index)
+        self.stream.write(dcapzip.INDEXED_TRAILER.pack(dcapzip.INDEXED_TRAILER_SIG, dcapzip.INDEXED_VERSION, 0,
+                                                       len(self.filelist), offset, zlib.crc32(index)))
+
+
+class IndexedMemberWriter:
+    """What ZipFile.open(zinfo, 'w') returns, for IndexedContainerWriter: compresses the data written, takes its size
+    and CRC-32 and adds the member to the index once it is complete."""
+
+    def __init__(self, archive, zinfo):
+        self.archive = archive
+        self.zinfo = zinfo
+        self.compressor = compressor((zinfo.compress_type, zinfo._compresslevel))
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # a member that failed half way stays out of the index
+        if exc_type is None:
+            self.close()
+
+    def _write_data(self, data):
+        self.zinfo.compress_size += len(data)
+        self.archive.stream.write(data)
+
+    def write(self, data):
+        self.zinfo.file_size += len(data)
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC)
+        self._write_data(data if self.compressor is None else self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self._write_data(self.compressor.flush())
+        self.archive.filelist.append(self.zinfo)
+
+
+CONTAINER_FORMATS = {'zip': ZipContainerWriter, 'indexed': IndexedContainerWriter}
 
 
 class Container:
 
-    def __init__(self, localtargetdir, dcap):
+    def __init__(self, localtargetdir, dcap, compression=(ZIP_STORED, None), container_format='zip'):
         self.filename = str(uuid.uuid1())
         self.localfilepath = os.path.join(localtargetdir, self.filename)
         pnfstargetdir = localtargetdir.replace(mount_point, data_root, 1)
@@ -48,54 +226,489 @@ class Container:
         self.logger = logging.getLogger(name=f"Container[{self.pnfsfilepath}]")
         self.logger.debug("Initializing")
 
-        self.dcaparc = dcap.open_file(self.pnfsfilepath, 'w')
-        self.arcfile = ZipFile(self.dcaparc, "w")
         global archive_user
         global archive_mode
         self.archiveUid = getpwnam(archive_user).pw_uid
         self.archiveMod = int(archive_mode, 8)
+
+        self.dcap = dcap
+        # owner and mode are set by the open, so closing the container needs no NFS mount
+        self.dcaparc = dcap.open_file(self.pnfsfilepath, 'w', rw_size, self.archiveUid, os.getgid(), self.archiveMod)
+        # None if the door doesn't report it, see create_archive_entry
+        self.pnfsid = self.dcaparc.pnfsid
+        self.writer = ChecksumWriter(self.dcaparc)
+        self.compression = compression
+        self.format = container_format
+        self.archive = CONTAINER_FORMATS[container_format](self.writer, compression)
+        # Adler32 of each member's data and the file it was read from, for verify=chksum
+        self.checksums = {}
+        self.sources = {}
         self.size = 0
         self.filecount = 0
 
     def close(self):
         self.logger.debug("Closing")
         try:
-            self.arcfile.close()
+            self.archive.close()
             self.dcaparc.close()
-            os.chown(self.localfilepath, self.archiveUid, os.getgid())
-            os.chmod(self.localfilepath, self.archiveMod)
         except InterruptedError:
             self.logger.error("Caught interuption signal. Cancelled closing.")
             raise InterruptedError
 
-    def add(self, pnfsid, filepath, localpath, size):
-        self.arcfile.write(localpath, arcname=pnfsid)
+    def add(self, pnfsid, filepath, localpath, size, prepared=None):
+        if prepared is None:
+            self.checksums[pnfsid] = self._write_streamed(localpath, pnfsid)
+        else:
+            self.archive.write_prepared(prepared.zinfo, prepared.data)
+            self.checksums[pnfsid] = prepared.adler32
+        self.sources[pnfsid] = localpath
         self.size += size
         self.filecount += 1
         self.logger.debug(f"Added file {filepath} with pnfsid {pnfsid}")
 
+    def _write_streamed(self, localpath, arcname):
+        # what ZipFile.write does, plus the Adler32 of the data on the way
+        zinfo = ZipInfo.from_file(localpath, arcname)
+        zinfo.compress_type, zinfo._compresslevel = self.archive.streamed_compression
+        adler32 = 1
+        with open(localpath, 'rb') as src:
+            data = src.read(copy_size)
+            if zinfo.compress_type != ZIP_STORED and \
+                    not worth_compressing(data[:compress_sample], (zinfo.compress_type, zinfo._compresslevel)):
+                zinfo.compress_type = ZIP_STORED
+            try:
+                with self.archive.open(zinfo) as dest:
+                    while len(data) > 0:
+                        adler32 = zlib.adler32(data, adler32)
+                        dest.write(data)
+                        data = src.read(copy_size)
+            except Exception:
+                # e.g. the source was deleted while it was read, the member must not end up in the filelist
+                self.archive.discard(zinfo)
+                raise
+        return adler32
+
+    def restore(self, entries):
+        # registers journaled members whose data has been copied into this container, see salvage_container
+        zinfos = [journal_zipinfo(entry) for entry in entries]
+        self.archive.restore(zinfos)
+        for entry, zinfo in zip(entries, zinfos):
+            self.checksums[zinfo.filename] = entry['adler32']
+            self.size += zinfo.file_size
+            self.filecount += 1
+
     def get_filelist(self):
-        return self.arcfile.filelist
+        return self.archive.filelist
+
+    def get_index(self):
+        # where each member is stored, so restores can seek straight to it without reading the central directory
+        return [{'pnfsid': info.filename, 'offset': info.header_offset, 'compressSize': info.compress_size,
+                 'fileSize': info.file_size, 'crc': info.CRC, 'compressType': info.compress_type}
+                for info in self.archive.filelist]
 
     def verify_filelist(self):
-        return len(self.arcfile.filelist) == self.filecount
+        return len(self.archive.filelist) == self.filecount
+
+    def verify_checksum(self):
+        # The members are checked against the checksums dCache holds for their source files. The container itself is
+        # checked against the Adler32 of what was sent, or read back and its members' CRC-32 checked if dCache has no
+        # checksum for it.
+        verified = True
+        for pnfsid, adler32 in self.checksums.items():
+            expected = dcache_adler32(self.sources[pnfsid])
+            if expected is None:
+                self.logger.warning(f"No Adler32 checksum in dCache for {pnfsid}, not verifying its data")
+            elif expected != adler32:
+                self.logger.error(f"Adler32 mismatch for {pnfsid}: read {adler32:08x}, dCache has {expected:08x}")
+                verified = False
+
+        expected = dcache_adler32(self.localfilepath)
+        if expected is None:
+            self.logger.info("No Adler32 checksum in dCache for the container, reading it back")
+            verified = self.verify_members() and verified
+        elif expected != self.writer.adler32:
+            self.logger.error(f"Adler32 mismatch for the container: sent {self.writer.adler32:08x}, dCache has "
+                              f"{expected:08x}")
+            verified = False
+        return verified
+
+    def verify_members(self):
+        members = [dcapzip.Member(info.filename, info.header_offset, info.compress_size, info.file_size, info.CRC,
+                                  info.compress_type) for info in self.archive.filelist]
+        verified = True
+        with self.dcap.open_file(self.pnfsfilepath, 'r') as stream:
+            for member, error in dcapzip.verify_members(stream, members):
+                if error is not None:
+                    self.logger.error(f"Member {member.name} is damaged: {str(error)}")
+                    verified = False
+        return verified
+
+
+class ContainerJournal:
+    """Records the members of a container whose data the mover has acknowledged. The container has one db.journal
+    document holding the number of journaled members and bytes, the members are db.journal_members documents of their
+    own, numbered by seq. If the packer dies while writing, the next start copies the journaled members into a new
+    container instead of packing them again, see resume_containers."""
+
+    def __init__(self, db, container, interval):
+        self.db = db
+        self.container = container
+        self.interval = interval
+        self.committed = 0
+        self.count = 0
+        # the _id of each member's file record, by pnfsid
+        self.file_ids = {}
+        self.db.journal.insert_one({'_id': container.pnfsfilepath, 'script': script_id, 'format': container.format,
+                                    'localpath': container.localfilepath, 'committed': 0, 'count': 0})
 
-    def verify_checksum(self, chksum):
-        self.logger.warning("Checksum verification not implemented, yet")
-        return True
+    def record(self, pnfsid, file_id):
+        # called for each member added to the container, file_id is the _id of its file record
+        self.file_ids[pnfsid] = file_id
+        if self.container.writer.tell() - self.committed >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.container.dcaparc.sync()
+        filelist = self.container.archive.filelist
+        entries = []
+        for seq, info in enumerate(filelist[self.count:], self.count):
+            entry = journal_entry(info, self.file_ids[info.filename], self.container.checksums[info.filename])
+            entry['container'] = self.container.pnfsfilepath
+            entry['seq'] = seq
+            entries.append(entry)
+        committed = self.container.writer.tell()
+        if entries:
+            self.db.journal_members.insert_many(entries)
+        # members beyond count are ignored by the salvage, should the packer die before this update
+        self.db.journal.update_one({'_id': self.container.pnfsfilepath},
+                                   {'$set': {'committed': committed, 'count': self.count + len(entries)}})
+        self.count += len(entries)
+        self.committed = committed
+
+    def remove(self):
+        remove_journal(self.db, self.container.pnfsfilepath)
+
+
+def remove_journal(db, container_path):
+    db.journal.delete_one({'_id': container_path})
+    db.journal_members.delete_many({'container': container_path})
+
+
+def journal_members(db, journal):
+    members = db.journal_members.find({'container': journal['_id'], 'seq': {'$lt': journal.get('count', 0)}})
+    return list(members.sort('seq', ASCENDING))
+
+
+def journal_entry(info, file_id, adler32):
+    return {'fileId': file_id, 'pnfsid': info.filename, 'offset': info.header_offset,
+            'compressSize': info.compress_size, 'fileSize': info.file_size, 'crc': info.CRC,
+            'compressType': info.compress_type, 'flagBits': info.flag_bits, 'dateTime': list(info.date_time),
+            'externalAttr': info.external_attr, 'adler32': adler32}
+
+
+def journal_zipinfo(entry):
+    zinfo = ZipInfo(entry['pnfsid'], tuple(entry['dateTime']))
+    zinfo.header_offset = entry['offset']
+    zinfo.compress_size = entry['compressSize']
+    zinfo.file_size = entry['fileSize']
+    zinfo.CRC = entry['crc']
+    zinfo.compress_type = entry['compressType']
+    zinfo.flag_bits = entry['flagBits']
+    zinfo.external_attr = entry['externalAttr']
+    return zinfo
+
+
+class PreparedMember:
+
+    def __init__(self, zinfo, data, adler32):
+        self.zinfo = zinfo
+        self.data = data
+        self.adler32 = adler32
+
+
+def local_path(f):
+    return f['path'].replace(data_root, mount_point, 1)
+
+
+def parse_compression(value):
+    # <method>[:<level>], e.g. deflate:9 or zstd:3
+    method, _, level = value.strip().lower().partition(':')
+    compress_type = COMPRESSION_METHODS.get(method)
+    if compress_type is None:
+        logging.warning(f"Unknown compression method {method}. Storing files uncompressed!")
+        return ZIP_STORED, None
+    if compress_type == dcapzip.ZIP_ZSTANDARD and dcapzip.zstandard is None:
+        logging.warning("zstd needs the zstandard module, which is not installed. Compressing with deflate!")
+        return ZIP_DEFLATED, None
+    return compress_type, int(level) if level else None
+
+
+def compressor(compression):
+    # None for stored members
+    compress_type, compress_level = compression
+    if compress_type == dcapzip.ZIP_ZSTANDARD:
+        return dcapzip.zstandard.ZstdCompressor(level=3 if compress_level is None else compress_level).compressobj()
+    return zipfile._get_compressor(compress_type, compress_level)
+
+
+def compress(data, compression):
+    c = compressor(compression)
+    return c.compress(data) + c.flush()
+
+
+def worth_compressing(sample, compression):
+    # already compressed data, e.g. images or archives, hardly shrinks and is stored
+    return len(compress(sample, compression)) <= len(sample) * (1 - compress_min_saving)
+
+
+def prepare_member(localpath, arcname, compression):
+    # runs in a prefetch thread, or in a worker process if the container is compressed
+    zinfo = ZipInfo.from_file(localpath, arcname)
+    with open(localpath, 'rb') as f:
+        data = f.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    adler32 = zlib.adler32(data)
+    zinfo.compress_type = ZIP_STORED
+    compress_type = compression[0]
+    if compress_type != ZIP_STORED and (len(data) <= compress_sample or
+                                        worth_compressing(data[:compress_sample], compression)):
+        compressed = compress(data, compression)
+        if len(compressed) <= len(data) * (1 - compress_min_saving):
+            data = compressed
+            zinfo.compress_type = compress_type
+            if compress_type == dcapzip.ZIP_ZSTANDARD:
+                zinfo.extract_version = dcapzip.ZSTANDARD_VERSION
+    zinfo.compress_size = len(data)
+    return PreparedMember(zinfo, data, adler32)
+
+
+def ignore_signals():
+    # SIGINT and SIGTERM are handled by the packer, which stops its prefetch workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def prefetch_members(files, compression, workers, memory):
+    # Yields (f, prepared member, error) in the order of files. While the caller writes one member, the following
+    # files are read and checksummed by `workers` threads, holding at most about `memory` bytes. Files bigger than
+    # memory / workers are not prefetched and yielded without a prepared member, as are all files if workers is 0.
+    # Compression keeps a core busy per file, so compressed containers are prepared by `workers` processes instead.
+    if workers <= 0:
+        for f in files:
+            yield f, None, None
+        return
+
+    max_member = memory // workers
+    files = iter(files)
+    pending = deque()
+    in_flight = 0
+    if compression[0] == ZIP_STORED:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+    else:
+        # forkserver, as forking the threaded packer could copy locks held by its other threads
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                                       initializer=ignore_signals)
+    with executor:
+        try:
+            while True:
+                while not pending or in_flight < memory:
+                    f = next(files, None)
+                    if f is None:
+                        break
+                    future = None
+                    if f['size'] <= max_member:
+                        future = executor.submit(prepare_member, local_path(f), f['pnfsid'], compression)
+                        in_flight += f['size']
+                    pending.append((f, future))
+                if not pending:
+                    break
+
+                f, future = pending.popleft()
+                if future is None:
+                    yield f, None, None
+                    continue
+                in_flight -= f['size']
+                try:
+                    prepared = future.result()
+                except OSError as e:
+                    yield f, None, e
+                else:
+                    yield f, prepared, None
+        finally:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
+
+
+class UpdateQueue:
+
+    def __init__(self, collection, batch_size):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.requests = []
+
+    def add(self, request):
+        self.requests.append(request)
+        if len(self.requests) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.requests:
+            self.collection.bulk_write(self.requests, ordered=False)
+            self.requests = []
+
+
+class ContainerPlan:
+
+    def __init__(self):
+        self.files = []
+        self.size = 0
+
+    def add(self, f):
+        self.files.append(f)
+        self.size += f['size']
+
+
+def plan_containers(candidates, archive_size, min_fill, window, pack_remaining):
+    # Windowed first-fit: candidates arrive in ctime order and go into the first of at most `window` open plans
+    # they fit in, so no container exceeds archive_size and old files are not held back behind younger ones. A plan
+    # is complete once it is filled to min_fill * archive_size or when it is pushed out of the window, and is yielded
+    # right away, so only the open plans are held in memory. Remaining plans are only packed if pack_remaining is set
+    # (old-file-mode), otherwise their files wait for the next run.
+    open_plans = []
+    fill_threshold = min_fill * archive_size
+    for f in candidates:
+        if f['size'] >= fill_threshold:
+            plan = ContainerPlan()
+            plan.add(f)
+            yield plan
+            continue
+
+        for plan in open_plans:
+            if plan.size + f['size'] <= archive_size:
+                break
+        else:
+            if len(open_plans) >= window:
+                yield open_plans.pop(0)
+            plan = ContainerPlan()
+            open_plans.append(plan)
+
+        plan.add(f)
+        if plan.size >= fill_threshold:
+            open_plans.remove(plan)
+            yield plan
+
+    if pack_remaining:
+        yield from open_plans
+
+
+def create_archive_entry(db, container, logger):
+    container_local_path = container.localfilepath
+    container_chimera_path = container.pnfsfilepath
+    container_pnfsid = container.pnfsid
+    try:
+        if container_pnfsid is None:
+            # the door didn't report the pnfsid with the open, it is looked up on the mount
+            container_pnfsid = read_dotfile(container_local_path, 'id')
+
+        index = container.get_index()
+        for entry in index:
+            entry['archiveId'] = container_pnfsid
+        if index:
+            db.archive_index.insert_many(index, ordered=False)
+        db.archives.insert({'pnfsid': container_pnfsid, 'path': container_chimera_path})
+    except InterruptedError:
+        logger.error("Got interruption signal. Remove entry.")
+        if container_pnfsid:
+            db.archive_index.delete_many({'archiveId': container_pnfsid})
+            db.archives.remove({'pnfsid': container_pnfsid, 'path': container_chimera_path})
+    except IOError as e:
+        logger.critical(
+            f"Could not find archive file {container_chimera_path}, referred to by file entries in database! This "
+            f"needs immediate attention or you will lose data!")
+
+
+def salvage_container(db, journal, members, logger):
+    # dCache files can't be truncated or appended to, so the journaled part of the interrupted container is copied
+    # into a new one of the same format, which gets the central directory or index
+    committed = journal['committed']
+    with dcap_pool.open_file(journal['_id'], 'r') as old:
+        size = old.seek(0, DCAP_SEEK_END)
+        if size < committed:
+            raise RuntimeError(f"only {size} of {committed} journaled bytes were stored")
+        old.seek(0)
+
+        container = Container(os.path.dirname(journal['localpath']), dcap_pool,
+                              container_format=journal.get('format', 'zip'))
+        try:
+            buffer = memoryview(bytearray(copy_size))
+            remaining = committed
+            while remaining > 0:
+                n = old.readinto(buffer[:min(copy_size, remaining)])
+                if n == 0:
+                    raise RuntimeError(f"{journal['_id']} ended at {committed - remaining} of {committed} bytes")
+                container.writer.write(buffer[:n])
+                remaining -= n
+            container.restore(members)
+            container.close()
+        except (OSError, RuntimeError):
+            discard_container(container, logger)
+            raise
+
+    file_ids = [entry['fileId'] for entry in members]
+    db.files.update_many({'_id': {'$in': file_ids}, 'status': {'$in': ['new', 'added']}},
+                         {'$set': {'status': 'archived', 'archive': container.pnfsfilepath},
+                          '$unset': {'lock': "", 'claim': ""}})
+    create_archive_entry(db, container, logger)
+    logger.info(f"Salvaged {container.filecount} files [{committed} bytes] into {container.pnfsfilepath}")
+
+
+def discard_container(container, logger):
+    try:
+        container.dcaparc.close()
+    except (OSError, RuntimeError) as e:
+        logger.debug(f"Closing discarded container {container.pnfsfilepath} failed: {str(e)}")
+    if os.path.exists(container.localfilepath):
+        os.remove(container.localfilepath)
+
+
+def resume_containers(db):
+    for journal in db.journal.find({'script': script_id}):
+        logger = logging.getLogger(name=f"Container[{journal['_id']}]")
+        if db.files.count_documents({'archive': journal['_id'], 'status': {'$in': ['archived', 'verified']}},
+                                    limit=1):
+            # the packer stopped after archiving the container's files, the container stays as it is
+            logger.warning(f"Files are archived in the journaled container {journal['_id']}, not salvaging it")
+            if db.files.count_documents({'archive': journal['_id'], 'status': 'archived'}, limit=1) and \
+                    not db.archives.count_documents({'path': journal['_id']}, limit=1):
+                logger.critical(f"Container {journal['_id']} has archived files but no archive entry! This needs "
+                                f"immediate attention or you will lose data!")
+            remove_journal(db, journal['_id'])
+            continue
+        members = journal_members(db, journal)
+        if members:
+            try:
+                salvage_container(db, journal, members, logger)
+            except (OSError, RuntimeError) as e:
+                logger.error(f"Could not salvage interrupted container, its files are packed again: {str(e)}")
+        if os.path.exists(journal['localpath']):
+            os.remove(journal['localpath'])
+        remove_journal(db, journal['_id'])
 
 
 class UserInterruptException(Exception):
-    def __init__(self, arcfile):
-        self.arcfile = arcfile
+    def __init__(self, *arcfiles):
+        self.arcfiles = [arcfile for arcfile in arcfiles if arcfile]
 
     def __str__(self):
-        return repr(self.arcfile)
+        return repr(self.arcfiles)
 
 
 class GroupPackager:
 
-    def __init__(self, path, file_pattern, s_group, store_name, archive_path, archive_size, min_age, max_age, verify):
+    def __init__(self, path, file_pattern, s_group, store_name, archive_path, archive_size, min_age, max_age, verify,
+                 min_fill, plan_window, compression, container_format):
         self.path = path
         self.path_pattern = re.compile(os.path.join(path, file_pattern))
         self.s_group = re.compile(s_group)
@@ -108,6 +721,13 @@ class GroupPackager:
         self.min_age = int(min_age)
         self.max_age = int(max_age)
         self.verify = verify
+        self.min_fill = float(min_fill)
+        self.plan_window = int(plan_window)
+        self.compression = parse_compression(compression)
+        self.container_format = container_format
+        if self.container_format not in CONTAINER_FORMATS:
+            logging.warning(f"Unknown container format {self.container_format}. Writing zip containers!")
+            self.container_format = 'zip'
         self.client = MongoClient(mongo_uri)
         self.db = self.client[mongo_db]
         self.logger = logging.getLogger(name=f"GroupPackager[{self.path_pattern.pattern}]")
@@ -121,7 +741,7 @@ class GroupPackager:
         if self.verify == 'filelist':
             verified = container.verify_filelist()
         elif self.verify == 'chksum':
-            verified = container.verify_checksum(0)
+            verified = container.verify_checksum()
         elif self.verify == 'off':
             verified = True
         else:
@@ -131,20 +751,7 @@ class GroupPackager:
         return verified
 
     def create_archive_entry(self, container):
-        container_local_path = container.localfilepath
-        container_chimera_path = container.pnfsfilepath
-        try:
-            container_pnfsid = read_dotfile(container_local_path, 'id')
-
-            self.db.archives.insert({'pnfsid': container_pnfsid, 'path': container_chimera_path})
-        except InterruptedError:
-            self.logger.error("Got interruption signal. Remove entry.")
-            if container_pnfsid:
-                self.db.archives.remove({'pnfsid': container_pnfsid, 'path': container_chimera_path})
-        except IOError as e:
-            self.logger.critical(
-                f"Could not find archive file {container_chimera_path}, referred to by file entries in database! This "
-                f"needs immediate attention or you will lose data!")
+        create_archive_entry(self.db, container, self.logger)
 
     def write_status(self, arcfile, current_size, next_file):
         global script_id
@@ -153,206 +760,288 @@ class GroupPackager:
             statusFile.write(f"Size: {current_size}/{self.archive_size}\n")
             statusFile.write(f"Next: {next_file.encode('ascii', 'ignore')}\n")
 
-    def run(self):
+    def candidate_query(self, ctime_threshold):
+        # the prefix on parent lets the server use the (status, parent, ctime) index
+        return {'status': 'new', 'lock': {'$exists': False}, 'parent': re.compile(f"^{re.escape(self.path)}"),
+                'path': self.path_pattern, 'group': self.s_group, 'store': self.store_name,
+                'ctime': {'$lt': ctime_threshold}}
+
+    def claim_files(self, plan):
+        # Packagers may run concurrently and their patterns may overlap, so the planned files are locked with a
+        # token of their own first. Only the files that could be locked are written into the container.
+        claim = str(uuid.uuid1())
+        self.db.files.update_many({'_id': {'$in': [f['_id'] for f in plan.files]}, 'status': 'new',
+                                   'lock': {'$exists': False}},
+                                  {'$set': {'lock': script_id, 'claim': claim}})
+        claimed = set(f['_id'] for f in self.db.files.find({'claim': claim}, {'_id': True}))
+        if len(claimed) < len(plan.files):
+            self.logger.info(f"{len(plan.files) - len(claimed)} of {len(plan.files)} planned files have been "
+                             f"claimed by another packager")
+            claimed_plan = ContainerPlan()
+            for f in plan.files:
+                if f['_id'] in claimed:
+                    claimed_plan.add(f)
+            plan.files = claimed_plan.files
+            plan.size = claimed_plan.size
+        return claim
+
+    def release_files(self, claim):
+        self.db.files.update_many({'claim': claim, 'status': 'new'}, {'$unset': {'lock': "", 'claim': ""}})
+
+    def summarize_candidates(self, query):
+        # count, combined size and oldest ctime are computed by the server, so the candidates only have to be
+        # streamed once, for packing
+        summary = next(self.db.files.aggregate([
+            {'$match': query},
+            {'$group': {'_id': None, 'count': {'$sum': 1}, 'size': {'$sum': '$size'}, 'oldest': {'$min': '$ctime'}}}
+        ]), None)
+        if summary is None:
+            return 0, 0, None
+        return summary['count'], summary['size'], summary['oldest']
+
+    def write_container(self, dcap, plan):
         global script_id
         global running
-        global dcap_url
-        dcap = Dcap(dcap_url)
-        try:
-            now = int(datetime.now().strftime("%s"))
-            ctime_threshold = (now - self.min_age * 60)
-            self.logger.debug(
-                f"Looking for files matching {{ path: {self.path_pattern.pattern}, group: {self.s_group.pattern}, "
-                f"store: {self.store_name.pattern}, ctime: {{ $lt: {ctime_threshold} }} }}")
-            with self.db.files.find(
-                    {'state': 'new', 'path': self.path_pattern, 'group': self.s_group, 'store': self.store_name,
-                     'ctime': {'$lt': ctime_threshold}}, timeout=False).batch_size(512) as cursor:
-                cursor.sort('ctime', ASCENDING)
-                sumsize = 0
-                old_file_mode = False
-                ctime_oldfile_threshold = (now - self.max_age * 60)
-                for f in cursor:
-                    if f['ctime'] < ctime_oldfile_threshold:
-                        old_file_mode = True
-                    sumsize += f['size']
+        claim = self.claim_files(plan)
+        if not plan.files:
+            return
 
-                filecount = cursor.count()
+        container = Container(self.archive_path, dcap, self.compression, self.container_format)
+        container_chimera_path = container.pnfsfilepath
+        # state changes are queued and written in batches, but always before the container is closed
+        updates = UpdateQueue(self.db.files, db_batch_size)
+        added = []
+        journal = ContainerJournal(self.db, container, journal_interval) if journal_interval > 0 else None
+        keep_journal = False
+        interrupted = False
+        archived = False
+        self.logger.info(
+            f"Creating new container {container.pnfsfilepath} for {len(plan.files)} files [{plan.size} bytes].")
+        members = prefetch_members(plan.files, container.compression, prefetch_workers, prefetch_memory)
+        try:
+            for f, prepared, error in members:
+                self.logger.debug(f"Next file {f['path']} [{f['pnfsid']}]")
+                if not running:
+                    if container.filecount == 0:
+                        raise UserInterruptException(container.localfilepath)
+                    # stopped between two files: the container is finished with the files it holds
+                    self.logger.info(f"Interrupted, closing container {container.pnfsfilepath} with "
+                                     f"{container.filecount} files")
+                    interrupted = True
+                    break
+
+                self.logger.debug(f"{plan.size - container.size} bytes remaining for this archive")
+                self.write_status(container.pnfsfilepath, plan.size - container.size, f"{f['path']} [{f['pnfsid']}]")
 
-                self.logger.info(f"found {filecount} files with a combined size of {sumsize} bytes")
-                if old_file_mode:
-                    self.logger.debug(f"containing old files: ctime < {ctime_oldfile_threshold}")
-                else:
-                    self.logger.debug(f"containing no old files: ctime < {ctime_oldfile_threshold}")
-
-                if old_file_mode:
-                    if sumsize < self.archive_size:
-                        self.logger.info(
-                            "combined size of old files not big enough for a regular archive, packing in old-file-mode")
-
-                    else:
-                        old_file_mode = False
-                        self.logger.info(
-                            "combined size of old files big enough for regular archive, packing in normal mode")
-                elif sumsize < self.archive_size:
-                    self.logger.info(
-                        f"no old files found and {self.archive_size - sumsize} bytes missing to create regular "
-                        f"archive of size {self.archive_size}, leaving packager")
-                    return
-
-                cursor.rewind()
-                container = None
-                container_chimera_path = None
                 try:
-                    for f in cursor:
-                        if filecount <= 0 or sumsize <= 0:
-                            self.logger.info(
-                                "Actual number of files exceeds precalculated number, will collect new files in next "
-                                "run.")
-                            break
-
-                        self.logger.debug(
-                            f"Next file {f['path']} [{f['pnfsid']}], remaining {filecount} [{sumsize} bytes]")
-                        if not running:
-                            if container:
-                                raise UserInterruptException(container.localfilepath)
-                            else:
-                                raise UserInterruptException(None)
-
-                        if container is None:
-                            if sumsize >= self.archive_size or old_file_mode:
-                                container = Container(self.archive_path, dcap)
-                                self.logger.info(
-                                    f"Creating new container {container.pnfsfilepath} . {filecount} files "
-                                    f"[{sumsize} bytes] remaining.")
-                            else:
-                                self.logger.info(
-                                    f"remaining combined size {sumsize} < {self.archive_size}, leaving packager")
-                                return
-
-                        if old_file_mode:
-                            self.logger.debug(f"{sumsize} bytes remaining for this archive")
-                            self.write_status(container.pnfsfilepath, sumsize, f"{f['path']} [{f['pnfsid']}]")
-                        else:
-                            self.logger.debug(f"{self.archive_size - container.size} bytes remaining for this archive")
-                            self.write_status(container.pnfsfilepath, self.archive_size - container.size,
-                                              f"{f['path']} [{f['pnfsid']}]")
-
-                        try:
-                            localfile = f['path'].replace(data_root, mount_point, 1)
-                            self.logger.debug(f"before container.add({f['path']}[{f['pnfsid']}], {f['size']})")
-                            container.add(f['pnfsid'], f['path'], localfile, f['size'])
-                            self.logger.debug("before collection.save")
-                            f['state'] = f"added: {container.pnfsfilepath}"
-                            f['lock'] = script_id
-                            cursor.collection.save(f)
-                            self.logger.debug(f"Added file {f['path']} [{f['pnfsid']}]")
-                        except IOError as e:
-                            self.logger.exception(
-                                f"IOError while adding file {f['path']} to archive {container.pnfsfilepath} [{f['pnfsid']}], {str(e)}")
-                            self.logger.debug(f"Removing entry for file {f['pnfsid']}")
-                            self.db.files.remove({'pnfsid': f['pnfsid']})
-                        except OSError as e:
-                            self.logger.exception(
-                                f"OSError while adding file {f['path']} to archive {f['pnfsid']} [{container.pnfsfilepath}], {str(e)}")
-                            self.logger.debug(f"Removing entry for file {f['pnfsid']}")
-                            self.db.files.remove({'pnfsid': f['pnfsid']})
-                        except errors.OperationFailure as e:
-                            self.logger.error(
-                                f"Removing container {container.localfilepath} due to OperationalFailure. See below for details.")
-                            container.close()
-                            os.remove(container.localfilepath)
-                            raise e
-                        except errors.ConnectionFailure as e:
-                            self.logger.error(
-                                f"Removing container {container.localfilepath} due to ConnectionFailure. See below for details.")
-                            container.close()
-                            os.remove(container.localfilepath)
-                            raise e
-
-                        sumsize -= f['size']
-                        filecount -= 1
-
-                        if container.size >= self.archive_size:
-                            self.logger.debug(f"Closing full container {container.pnfsfilepath}")
-                            container_chimera_path = container.pnfsfilepath
-                            container.close()
-
-                            if self.verify_container(container):
-                                self.logger.info(f"Container {container.pnfsfilepath} successfully stored")
-                                self.db.files.update({'state': f'added: {container_chimera_path}'},
-                                                     {'$set': {'state': f'archived: {container_chimera_path}'},
-                                                      '$unset': {'lock': ""}}, multi=True)
-                                self.create_archive_entry(container)
-                            else:
-                                self.logger.warning(
-                                    f"Removing container {container.localfilepath} due to verification error")
-                                self.db.files.update({'state': f'added: {container_chimera_path}'},
-                                                     {'$set': {'state': 'new'}, '$unset': {'lock': ""}}, multi=True)
-                                os.remove(container.localfilepath)
-
-                            container = None
-
-                    if container:
-                        if not old_file_mode:
-                            self.logger.warning(
-                                f"Removing unful container {container.localfilepath} . Maybe a file was deleted "
-                                f"during packaging.")
-                            container.close()
-                            os.remove(container.localfilepath)
-                            return
-
-                        self.logger.debug(f"Closing container {container.pnfsfilepath} containing remaining old files")
-                        container_chimera_path = container.pnfsfilepath
-                        container.close()
-
-                        if self.verify_container(container):
-                            self.logger.info(f"Container {container.pnfsfilepath} with old files successfully stored")
-                            self.db.files.update({'state': f'added: {container_chimera_path}'},
-                                                 {'$set': {'state': f'archived: {container_chimera_path}'},
-                                                  '$unset': {'lock': ""}}, multi=True)
-                            self.create_archive_entry(container)
-                        else:
-                            self.logger.warning(
-                                f"Removing container {container.localfilepath} with old files due to verification error")
-                            self.db.files.update({'state': f'added: {container_chimera_path}'},
-                                                 {'$set': {'state': 'new'}, '$unset': {'lock': ""}}, multi=True)
-                            os.remove(container.localfilepath)
-                except InterruptedError:
-                    self.logger.info(f"Caught interruption. Cleanup")
-                    os.remove(container.localfilepath)
-                    # if lock is script_id, the state is set to new and lock removed when while-loop is entered
-                    # in main
-                    dcap.close()
-                    sys.exit("Interruption signal")
+                    if error is not None:
+                        raise error
+                    localfile = local_path(f)
+                    self.logger.debug(f"before container.add({f['path']}[{f['pnfsid']}], {f['size']})")
+                    container.add(f['pnfsid'], f['path'], localfile, f['size'], prepared)
+                    updates.add(UpdateOne({'_id': f['_id']},
+                                          {'$set': {'status': 'added', 'archive': container.pnfsfilepath}}))
+                    added.append(f['_id'])
+                    if journal is not None:
+                        journal.record(f['pnfsid'], f['_id'])
+                    self.logger.debug(f"Added file {f['path']} [{f['pnfsid']}]")
                 except IOError as e:
-                    self.logger.error(
-                        f"{e.strerror} closing file {container_chimera_path}. Trying to clean up files in state: "
-                        f"'added'. This might need additional manual fixing!")
-                    self.db.files.update({'state': f'added: {container_chimera_path}'},
-                                         {'$set': {'state': 'new'}, '$unset': {'lock': ""}}, multi=True)
+                    self.logger.exception(
+                        f"IOError while adding file {f['path']} to archive {container.pnfsfilepath} [{f['pnfsid']}], {str(e)}")
+                    self.logger.debug(f"Removing entry for file {f['pnfsid']}")
+                    self.db.files.remove({'pnfsid': f['pnfsid']})
+                except OSError as e:
+                    self.logger.exception(
+                        f"OSError while adding file {f['path']} to archive {f['pnfsid']} [{container.pnfsfilepath}], {str(e)}")
+                    self.logger.debug(f"Removing entry for file {f['pnfsid']}")
+                    self.db.files.remove({'pnfsid': f['pnfsid']})
                 except errors.OperationFailure as e:
+                    # the container is removed by the handler below
                     self.logger.error(
-                        f"Operation Exception in database communication while creating container "
-                        f"{container_chimera_path} . Please check!")
-                    self.logger.error(f'{str(e)}')
-                    os.remove(container.localfilepath)
+                        f"Removing container {container.localfilepath} due to OperationalFailure. See below for details.")
+                    container.close()
+                    raise e
                 except errors.ConnectionFailure as e:
                     self.logger.error(
-                        f"Connection Exception in database communication. Removing incomplete container "
-                        f"{container_chimera_path} .")
-                    self.logger.error(f'{str(e)}')
-                    os.remove(container.localfilepath)
-
-        finally:
+                        f"Removing container {container.localfilepath} due to ConnectionFailure. See below for details.")
+                    container.close()
+                    raise e
+
+            if container.filecount < len(plan.files) and not interrupted:
+                self.logger.warning(
+                    f"Container {container.pnfsfilepath} holds {container.filecount} of {len(plan.files)} planned "
+                    f"files. Maybe a file was deleted during packaging.")
+
+            if container.filecount == 0:
+                self.logger.warning(f"None of the {len(plan.files)} planned files could be added. Removing empty "
+                                    f"container {container.pnfsfilepath}")
+                discard_container(container, self.logger)
+                return
+
+            updates.flush()
+            self.logger.debug(f"Closing container {container.pnfsfilepath}")
+            container.close()
+
+            if self.verify_container(container):
+                self.logger.info(f"Container {container.pnfsfilepath} successfully stored")
+                # a container its files are archived in must never be salvaged, so the journal goes first
+                if journal is not None:
+                    journal.remove()
+                    journal = None
+                archived = True
+                self.db.files.update_many({'_id': {'$in': added}},
+                                          {'$set': {'status': 'archived'}, '$unset': {'lock': "", 'claim': ""}})
+                self.create_archive_entry(container)
+            else:
+                self.logger.warning(f"Removing container {container.localfilepath} due to verification error")
+                self.db.files.update_many({'_id': {'$in': added}},
+                                          {'$set': {'status': 'new'},
+                                           '$unset': {'archive': "", 'lock': "", 'claim': ""}})
+                os.remove(container.localfilepath)
+        except InterruptedError:
+            self.logger.info(f"Caught interruption. Cleanup")
+            if archived:
+                self.logger.warning(f"Keeping container {container.pnfsfilepath}, its files may be archived already")
+            elif journal is not None and journal.count:
+                # salvaged by resume_containers at the next start
+                self.logger.info(f"Keeping container {container.pnfsfilepath} with {journal.count} journaled files")
+                keep_journal = True
+            else:
+                os.remove(container.localfilepath)
+            # if lock is script_id, the state is set to new and lock removed when while-loop is entered
+            # in main
             dcap.close()
+            sys.exit("Interruption signal")
+        except IOError as e:
+            self.logger.error(
+                f"{e.strerror} closing file {container_chimera_path}. Trying to clean up files in status: "
+                f"'added'. This might need additional manual fixing!")
+            self.db.files.update_many({'_id': {'$in': added}},
+                                      {'$set': {'status': 'new'}, '$unset': {'archive': "", 'lock': "", 'claim': ""}})
+        except errors.OperationFailure as e:
+            self.logger.error(
+                f"Operation Exception in database communication while creating container "
+                f"{container_chimera_path} . Please check!")
+            self.logger.error(f'{str(e)}')
+            os.remove(container.localfilepath)
+        except errors.ConnectionFailure as e:
+            self.logger.error(
+                f"Connection Exception in database communication. Removing incomplete container "
+                f"{container_chimera_path} .")
+            self.logger.error(f'{str(e)}')
+            os.remove(container.localfilepath)
+        finally:
+            members.close()
+            self.release_files(claim)
+            if journal is not None and not keep_journal:
+                try:
+                    journal.remove()
+                except errors.PyMongoError as e:
+                    self.logger.error(f"Could not remove journal of {container.pnfsfilepath}: {str(e)}")
+
+        if interrupted:
+            raise UserInterruptException()
+
+    def run(self):
+        global script_id
+        global running
+        global dcap_pool
+        dcap = dcap_pool
+        now = int(datetime.now().strftime("%s"))
+        ctime_threshold = (now - self.min_age * 60)
+        self.logger.debug(
+            f"Looking for files matching {{ path: {self.path_pattern.pattern}, group: {self.s_group.pattern}, "
+            f"store: {self.store_name.pattern}, ctime: {{ $lt: {ctime_threshold} }} }}")
+        query = self.candidate_query(ctime_threshold)
+        filecount, sumsize, oldest_ctime = self.summarize_candidates(query)
+        ctime_oldfile_threshold = (now - self.max_age * 60)
+        old_file_mode = oldest_ctime is not None and oldest_ctime < ctime_oldfile_threshold
+
+        self.logger.info(f"found {filecount} files with a combined size of {sumsize} bytes")
+        if old_file_mode:
+            self.logger.debug(f"containing old files: ctime < {ctime_oldfile_threshold}")
+        else:
+            self.logger.debug(f"containing no old files: ctime < {ctime_oldfile_threshold}")
 
+        if old_file_mode:
+            if sumsize < self.archive_size:
+                self.logger.info(
+                    "combined size of old files not big enough for a regular archive, packing in old-file-mode")
 
-def read_dotfile(filepath, tag):
-    with open(os.path.join(os.path.dirname(filepath), f".({tag})({os.path.basename(filepath)})"), mode='r') as dotfile:
+            else:
+                old_file_mode = False
+                self.logger.info(
+                    "combined size of old files big enough for regular archive, packing in normal mode")
+        elif sumsize < self.archive_size:
+            self.logger.info(
+                f"no old files found and {self.archive_size - sumsize} bytes missing to create regular "
+                f"archive of size {self.archive_size}, leaving packager")
+            return
+
+        # each container is written as soon as its plan is complete, while the candidates are still streamed
+        planned = 0
+        planned_size = 0
+        with self.db.files.find(query, CANDIDATE_FIELDS, no_cursor_timeout=True).batch_size(512) as cursor:
+            cursor.sort('ctime', ASCENDING)
+            for plan in plan_containers(cursor, self.archive_size, self.min_fill, self.plan_window, old_file_mode):
+                if not running:
+                    raise UserInterruptException()
+                planned += 1
+                planned_size += plan.size
+                self.write_container(dcap, plan)
+
+        self.logger.info(f"planned {planned} containers with a combined size of {planned_size} bytes, "
+                         f"leaving {sumsize - planned_size} bytes for the next run")
+
+
+def run_packagers(group_packagers, pack_workers):
+    if pack_workers <= 1:
+        for packager in group_packagers:
+            packager.run()
+        return
+
+    # every packager has its own MongoDB client, the files are opened on the shared connections of dcap_pool
+    interrupted = []
+    with ThreadPoolExecutor(max_workers=pack_workers, thread_name_prefix='packager') as executor:
+        pending = [executor.submit(packager.run) for packager in group_packagers]
+        while pending:
+            try:
+                done, pending = wait(pending)
+            except InterruptedError:
+                # signals are handled by the main thread only, the workers stop as soon as they see running == False
+                continue
+            for future in done:
+                try:
+                    future.result()
+                except UserInterruptException as e:
+                    interrupted.extend(e.arcfiles)
+
+    if interrupted or not running:
+        raise UserInterruptException(*interrupted)
+
+
+def read_dotfile(filepath, tag, attribute=None):
+    name = f".({tag})({os.path.basename(filepath)})"
+    if attribute is not None:
+        name = f"{name}({attribute})"
+    with open(os.path.join(os.path.dirname(filepath), name), mode='r') as dotfile:
         result = dotfile.readline().strip()
     return result
 
 
+def dcache_adler32(filepath):
+    # .(get)(<file>)(checksum) lists the checksums dCache knows, e.g. ADLER32:0a1b2c3d
+    try:
+        checksums = read_dotfile(filepath, 'get', 'checksum')
+    except OSError:
+        return None
+    for checksum in re.split(r'[\s,;]+', checksums):
+        checksum_type, _, value = checksum.partition(':')
+        if checksum_type.upper() == 'ADLER32' and value:
+            return int(value, 16)
+    return None
+
+
 def main(configfile='/etc/dcache/container.conf'):
     global running
 
@@ -369,12 +1058,21 @@ def main(configfile='/etc/dcache/container.conf'):
         global mongo_uri
         global mongo_db
         global dcap_url
+        global rw_size
+        global dcap_pool
+        global db_batch_size
+        global prefetch_workers
+        global prefetch_memory
+        global journal_interval
 
         try:
             configuration = parser.RawConfigParser(
                 defaults={'scriptId': 'pack', 'archiveUser': 'root', 'archiveMode': '0644',
                           'mongoUri': 'mongodb://localhost/', 'mongoDb': 'smallfiles', 'loopDelay': 5,
-                          'logLevel': 'ERROR'})
+                          'logLevel': 'ERROR', 'minFill': '0.98', 'planWindow': 8, 'packWorkers': 1,
+                          'dbBatchSize': 1000, 'rwsize': 1048576, 'prefetchWorkers': 4,
+                          'prefetchMemory': 268435456, 'journalInterval': 1073741824, 'compression': 'stored',
+                          'containerFormat': 'zip'})
             configuration.read(configfile)
 
             script_id = configuration.get('DEFAULT', 'scriptId')
@@ -399,8 +1097,14 @@ def main(configfile='/etc/dcache/container.conf'):
             mongo_uri = configuration.get('DEFAULT', 'mongoUri')
             mongo_db = configuration.get('DEFAULT', 'mongodb')
             dcap_url = configuration.get('DEFAULT', 'dcapUrl')
+            rw_size = configuration.getint('DEFAULT', 'rwsize')
 
             loop_delay = configuration.getint('DEFAULT', 'loopDelay')
+            pack_workers = configuration.getint('DEFAULT', 'packWorkers')
+            db_batch_size = configuration.getint('DEFAULT', 'dbBatchSize')
+            prefetch_workers = configuration.getint('DEFAULT', 'prefetchWorkers')
+            prefetch_memory = configuration.getint('DEFAULT', 'prefetchMemory')
+            journal_interval = configuration.getint('DEFAULT', 'journalInterval')
 
             logging.info(f'Successfully read configuration from file {configfile}.')
             logging.debug(f'scriptId = {script_id}')
@@ -411,16 +1115,32 @@ def main(configfile='/etc/dcache/container.conf'):
             logging.debug(f'mongoUri = {mongo_uri}')
             logging.debug(f'mongoDb = {mongo_db}')
             logging.debug(f'dcapUrl = {dcap_url}')
+            logging.debug(f'rwsize = {rw_size}')
             logging.debug(f'logLevel = {log_level}')
             logging.debug(f'loopDelay = {loop_delay}')
+            logging.debug(f'packWorkers = {pack_workers}')
+            logging.debug(f'dbBatchSize = {db_batch_size}')
+            logging.debug(f'prefetchWorkers = {prefetch_workers}')
+            logging.debug(f'prefetchMemory = {prefetch_memory}')
+            logging.debug(f'journalInterval = {journal_interval}')
+
+            if dcap_pool is None or dcap_pool.url != dcap_url:
+                if dcap_pool is not None:
+                    dcap_pool.close()
+                dcap_pool = DcapPool(dcap_url, max(pack_workers, 1))
 
             try:
                 client = MongoClient(mongo_uri)
                 db = client[mongo_db]
                 logging.info("Established db connection")
+                sfdb.prepare(db)
+
+                logging.info("Resuming interrupted containers")
+                resume_containers(db)
 
                 logging.info("Sanitizing database")
-                db.files.update({'lock': script_id}, {'$set': {'state': 'new'}, '$unset': {'lock': ""}}, multi=True)
+                db.files.update_many({'lock': script_id},
+                                     {'$set': {'status': 'new'}, '$unset': {'archive': "", 'lock': "", 'claim': ""}})
 
                 logging.info("Creating group packagers")
                 groups = configuration.sections()
@@ -443,6 +1163,14 @@ def main(configfile='/etc/dcache/container.conf'):
                     logging.debug(f"maxAge: {max_age}")
                     verify = configuration.get(group, 'verify')
                     logging.debug(f"verify: {verify}")
+                    min_fill = configuration.get(group, 'minFill')
+                    logging.debug(f"minFill: {min_fill}")
+                    plan_window = configuration.get(group, 'planWindow')
+                    logging.debug(f"planWindow: {plan_window}")
+                    compression = configuration.get(group, 'compression')
+                    logging.debug(f"compression: {compression}")
+                    container_format = configuration.get(group, 'containerFormat')
+                    logging.debug(f"containerFormat: {container_format}")
                     pathre = re.compile(configuration.get(group, 'pathExpression'))
                     logging.debug(f"pathExpression: {pathre.pattern}")
                     paths = db.files.find({'parent': pathre}).distinct('parent')
@@ -462,13 +1190,16 @@ def main(configfile='/etc/dcache/container.conf'):
                             archive_size,
                             min_age,
                             max_age,
-                            verify)
+                            verify,
+                            min_fill,
+                            plan_window,
+                            compression,
+                            container_format)
                         group_packagers.append(packager)
                         logging.info(f"Added packager {group} for paths matching {packager.path}")
 
-                logging.info("Running packagers")
-                for packager in group_packagers:
-                    packager.run()
+                logging.info(f"Running packagers with {pack_workers} workers")
+                run_packagers(group_packagers, pack_workers)
 
                 client.close()
 
@@ -479,12 +1210,13 @@ def main(configfile='/etc/dcache/container.conf'):
             time.sleep(loop_delay)
 
         except UserInterruptException as e:
-            if e.arcfile:
-                logging.info(f"Cleaning up unfinished container {e.arcfile}.")
-                os.remove(e.arcfile)
+            for arcfile in e.arcfiles:
+                logging.info(f"Cleaning up unfinished container {arcfile}.")
+                os.remove(arcfile)
                 logging.info("Cleaning up modified file entries.")
-                container_chimera_path = e.arcfile.replace(mount_point, data_root, 1)
-                db.files.update({'state': f'added: {container_chimera_path}'}, {'$set': {'state': 'new'}}, multi=True)
+                container_chimera_path = arcfile.replace(mount_point, data_root, 1)
+                db.files.update_many({'status': 'added', 'archive': container_chimera_path},
+                                     {'$set': {'status': 'new'}, '$unset': {'archive': ""}})
 
             logging.info("Finished cleaning up. Exiting.")
             sys.exit(1)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import logging
+from pymongo import UpdateOne, ASCENDING, errors
+
+# Records in db.files carry a 'status' (new, added, archived, verified) and, once added to a container, the chimera
+# path of that container in 'archive'. Older records encode both in one string, e.g. state: 'added: <path>'.
+
+prepared = False
+DUPLICATE_KEY = 11000
+
+
+def ensure_index(collection, keys, name, **kwargs):
+    # An index on the same keys that exists already, e.g. pnfsid_1 from older installation notes, is kept. MongoDB
+    # refuses a second one under another name. If its options differ it has to be replaced by hand, e.g. a non-unique
+    # pnfsid index by a unique one once the duplicate records are removed.
+    for existing, info in collection.index_information().items():
+        if info['key'] == keys:
+            mismatched = {option: value for option, value in kwargs.items() if info.get(option, False) != value}
+            if mismatched:
+                logging.warning(f"Index {existing} on {collection.name} exists, but without the options {mismatched}. "
+                                f"Drop it to have it created as {name} with them.")
+            return existing
+    collection.create_index(keys, name=name, **kwargs)
+    return name
+
+
+def ensure_indexes(db):
+    try:
+        ensure_index(db.files, [('pnfsid', ASCENDING)], 'pnfsid', unique=True)
+    except errors.OperationFailure as e:
+        if e.code != DUPLICATE_KEY:
+            raise
+        logging.error(f"Could not create unique index on pnfsid, falling back to non-unique index: {str(e)}")
+        ensure_index(db.files, [('pnfsid', ASCENDING)], 'pnfsid_nonunique')
+    ensure_index(db.files, [('status', ASCENDING), ('parent', ASCENDING), ('ctime', ASCENDING)], 'status_parent_ctime')
+    ensure_index(db.files, [('status', ASCENDING), ('archive', ASCENDING)], 'status_archive')
+    ensure_index(db.files, [('parent', ASCENDING)], 'parent')
+    ensure_index(db.files, [('lock', ASCENDING)], 'lock', sparse=True)
+    ensure_index(db.files, [('claim', ASCENDING)], 'claim', sparse=True)
+    ensure_index(db.archives, [('pnfsid', ASCENDING)], 'pnfsid')
+    ensure_index(db.journal, [('script', ASCENDING)], 'script')
+    ensure_index(db.journal_members, [('container', ASCENDING), ('seq', ASCENDING)], 'container_seq')
+    ensure_index(db.archive_index, [('archiveId', ASCENDING), ('pnfsid', ASCENDING)], 'archiveId_pnfsid', unique=True)
+
+
+def migrate_states(db, batch_size=1000):
+    migrated = 0
+    requests = []
+    with db.files.find({'state': {'$exists': True}}, {'state': True}) as cursor:
+        for record in cursor:
+            status, _, archive = record['state'].partition(': ')
+            update = {'$set': {'status': status}, '$unset': {'state': ""}}
+            if archive:
+                update['$set']['archive'] = archive
+            requests.append(UpdateOne({'_id': record['_id'], 'state': record['state']}, update))
+            if len(requests) >= batch_size:
+                migrated += db.files.bulk_write(requests, ordered=False).modified_count
+                requests = []
+    if requests:
+        migrated += db.files.bulk_write(requests, ordered=False).modified_count
+    return migrated
+
+
+def prepare(db):
+    global prepared
+    if prepared:
+        return
+
+    logging.info("Ensuring indexes on the files collection")
+    ensure_indexes(db)
+    migrated = migrate_states(db)
+    if migrated:
+        logging.info(f"Migrated {migrated} file records to status/archive fields")
+    prepared = True
@@ -6,8 +6,10 @@ import sys
 import time
 import errno
 import signal
-from zipfile import ZipFile, BadZipfile
-from pymongo import MongoClient, errors
+from zipfile import BadZipfile
+from pymongo import MongoClient, UpdateOne, errors
+import sfdb
+import dcapzip
 import configparser as parser
 import logging
 import logging.handlers
@@ -81,6 +83,7 @@ def main(configfile='/etc/dcache/container.conf'):
                 client = MongoClient(mongo_uri)
                 db = client[mongo_db]
                 logging.info("Established db connection")
+                sfdb.prepare(db)
 
                 with db.archives.find() as archives:
                     for archive in archives:
@@ -90,23 +93,36 @@ def main(configfile='/etc/dcache/container.conf'):
                         try:
                             localpath = archive['path'].replace(data_root, mount_point, 1)
                             archive_pnfsid = archive['pnfsid']
-                            zf = ZipFile(localpath, mode='r', allowZip64=True)
-                            for f in zf.filelist:
-                                logging.debug(f"Entering bfid into record for file {f.filename}")
-                                filerecord = db.files.find_one(
-                                    {'pnfsid': f.filename, 'state': f'archived: {archive["path"]}'}, await_data=True)
-                                if filerecord:
+                            members = [entry['pnfsid'] for entry in
+                                       db.archive_index.find({'archiveId': archive_pnfsid}, {'pnfsid': True})]
+                            if not members:
+                                # archives packed before the index was introduced, zip or indexed
+                                with open(localpath, 'rb') as f:
+                                    members = [member.name for member in dcapzip.iter_members(f)]
+                            logging.debug(f"Entering bfids into records for {len(members)} files")
+                            requests = []
+                            found = set()
+                            with db.files.find({'pnfsid': {'$in': members}, 'status': 'archived',
+                                                'archive': archive['path']},
+                                               {'pnfsid': True, 'store': True, 'group': True}) as filerecords:
+                                for filerecord in filerecords:
                                     url = f"dcache://dcache/?store={filerecord['store']}&group={filerecord['group']}" \
-                                          f"&bfid={f.filename}:{archive_pnfsid} "
-                                    filerecord['archiveUrl'] = url
-                                    filerecord['state'] = f'verified: {archive["path"]}'
-                                    db.files.save(filerecord)
-                                    logging.debug(f"Updated record with URL {url} in archive {archive['path']}")
-                                else:
-                                    logging.warning(
-                                        f"File {f.filename} in archive {archive['path']} has no entry in DB. This "
-                                        f"could be caused by a previous forced interrupt. Creating failure entry.")
-                                    db.failures.insert({'archiveId': archive_pnfsid, 'pnfsid': f.filename})
+                                          f"&bfid={filerecord['pnfsid']}:{archive_pnfsid} "
+                                    requests.append(UpdateOne({'_id': filerecord['_id']},
+                                                              {'$set': {'archiveUrl': url, 'status': 'verified'}}))
+                                    found.add(filerecord['pnfsid'])
+                            if requests:
+                                db.files.bulk_write(requests, ordered=False)
+                                logging.debug(f"Updated {len(requests)} records in archive {archive['path']}")
+
+                            missing = [member for member in members if member not in found]
+                            for member in missing:
+                                logging.warning(
+                                    f"File {member} in archive {archive['path']} has no entry in DB. This "
+                                    f"could be caused by a previous forced interrupt. Creating failure entry.")
+                            if missing:
+                                db.failures.insert_many([{'archiveId': archive_pnfsid, 'pnfsid': member}
+                                                         for member in missing])
 
                             logging.debug(f"stat({localpath}): {os.stat(localpath)}")
 
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Thin client for hsm-helper.py, called by hsm-internal.sh with the helper's socket followed by the arguments of
+# hsm-internal.sh. Exits with the return code of the request, or with HELPER_UNREACHABLE if the helper could not be
+# asked, so that hsm-internal.sh can handle the request itself.
+
+import sys
+import json
+import socket
+
+HELPER_UNREACHABLE = 111
+
+
+def main(path, args):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            s.sendall((json.dumps({'args': args}) + '\n').encode('utf-8'))
+            with s.makefile('r', encoding='utf-8') as f:
+                reply = f.readline()
+    except OSError:
+        return HELPER_UNREACHABLE
+
+    if not reply:
+        return HELPER_UNREACHABLE
+
+    reply = json.loads(reply)
+    if reply['output']:
+        print(reply['output'])
+    if reply['message']:
+        print(reply['message'], file=sys.stderr)
+    return reply['rc']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: hsm-client.py <socket> put|get <pnfsId> <filePath> [-key[=value] ...]")
+        sys.exit(4)
+
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
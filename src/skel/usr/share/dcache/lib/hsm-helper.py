@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Long running helper for hsm-internal.sh. It serves the put and get requests of the pool over a Unix socket,
+# keeps its MongoDB connections open and answers with the return codes dCache expects from the HSM script.
+# hsm-client.py forwards the arguments of hsm-internal.sh unchanged.
+
+import os
+import re
+import sys
+import json
+import signal
+import time
+import threading
+import socketserver
+import logging
+import logging.handlers
+from pymongo import MongoClient, errors
+from dcap import DcapPool
+import dcapzip
+
+socket_path = '/var/run/dcache/hsm-helper.sock'
+# seconds a get request waits for further requests of the same archive
+recall_delay = 1.0
+# seconds a get request waits for its archive to be restored
+recall_timeout = 3600.0
+
+clients = {}
+dcap_pools = {}
+clients_lock = threading.Lock()
+
+
+class HsmError(Exception):
+    def __init__(self, rc, message):
+        self.rc = rc
+        self.message = message
+
+    def __str__(self):
+        return f"{self.message} ({self.rc})"
+
+
+def get_db(mongo_url):
+    # mongoUrl is given the way the mongo shell expects it: <host>[:<port>]/<database>
+    host, _, dbname = mongo_url.partition('/')
+    with clients_lock:
+        client = clients.get(host)
+        if client is None:
+            client = MongoClient(f"mongodb://{host}/")
+            clients[host] = client
+    return client[dbname]
+
+
+def get_dcap_pool(door):
+    with clients_lock:
+        pool = dcap_pools.get(door)
+        if pool is None:
+            pool = DcapPool(f"dcap://{door}", max_connections=4)
+            dcap_pools[door] = pool
+    return pool
+
+
+def parse_args(args):
+    positional = []
+    options = {}
+    for arg in args:
+        if arg.startswith('-'):
+            key, _, value = arg[1:].partition('=')
+            options[key] = value
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+def parse_storage_info(si):
+    storage_info = {}
+    for item in si.split(';'):
+        key, _, value = item.partition('=')
+        if key:
+            storage_info[key] = value
+    return storage_info
+
+
+def dataset_put(db, store, group, pnfsid):
+    # same as datasetPut.js
+    entry = db.files.find_one({'pnfsid': pnfsid})
+    if entry is None:
+        try:
+            db.files.insert_one({'pnfsid': pnfsid, 'store': store, 'group': group})
+        except errors.DuplicateKeyError:
+            pass
+        raise HsmError(72, "Not yet ready")
+
+    url = entry.get('archiveUrl')
+    if not url or 'dcache:' not in url:
+        raise HsmError(72, "Not yet ready (empty)")
+
+    db.files.delete_one({'pnfsid': pnfsid})
+    return url
+
+
+def put(options, pnfsid, filename, storage_info):
+    try:
+        filesize = os.stat(filename).st_size
+    except OSError:
+        raise HsmError(31, f"File not found : {filename}")
+
+    store = storage_info.get('store', '')
+    group = storage_info.get('group', '')
+    if filesize == 0:
+        result = f"dcache://dcache/store={store}&group={group}&bfid={pnfsid}:*"
+    else:
+        result = dataset_put(get_db(options['mongoUrl']), store, group, pnfsid)
+
+    logging.info(f"{pnfsid} Result : {result}")
+    return result
+
+
+def parse_uri(uri):
+    store = re.match(r".*/?store=(.*)&group.*", uri)
+    group = re.match(r".*group=(.*)&bfid.*", uri)
+    bfid = re.match(r".*bfid=(.*)", uri)
+    if store is None or group is None or bfid is None:
+        raise HsmError(22, f"couldn't get sufficient info for 'copy' : uri=>{uri}<")
+    return store.group(1), group.group(1), bfid.group(1).strip()
+
+
+class Recall:
+
+    def __init__(self, original_id, filename):
+        self.original_id = original_id
+        self.filename = filename
+        self.done = threading.Event()
+        self.error = None
+
+
+class RecallQueue:
+    """Collects the get requests for one archive for a short while and restores them together: the members are
+    looked up with one query, sorted by offset and read from a single open of the archive. After a recall from
+    tape dCache usually stages many files of the same container at once."""
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, options, archive_id, original_id, filename):
+        recall = Recall(original_id, filename)
+        key = (options['dcapDoor'], options['mongoUrl'], archive_id)
+        with self.lock:
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = []
+                self.pending[key] = batch
+                delay = float(options.get('recallDelay', recall_delay))
+                timer = threading.Timer(delay, self._restore, (key, options))
+                timer.daemon = True
+                timer.start()
+            batch.append(recall)
+
+        timeout = float(options.get('recallTimeout', recall_timeout))
+        if not recall.done.wait(timeout):
+            logging.error(f"{original_id} Restore from archive {archive_id} did not finish within {timeout:.0f} s")
+            raise HsmError(243, f"Couldn't replay the file from archive {archive_id} in time")
+        if recall.error is not None:
+            raise recall.error
+
+    def _restore(self, key, options):
+        with self.lock:
+            batch = self.pending.pop(key)
+        archive_id = key[2]
+        try:
+            restore_batch(options, archive_id, batch)
+        except errors.PyMongoError as e:
+            logging.error(f"Error running mongo query for archive {archive_id}: {str(e)}")
+            for recall in batch:
+                if not recall.done.is_set():
+                    recall.error = HsmError(102, "Error running mongo query")
+                    recall.done.set()
+        except Exception as e:
+            logging.error(f"Restoring {len(batch)} files from archive {archive_id} failed: {str(e)}")
+        finally:
+            # every waiting request gets an answer
+            for recall in batch:
+                if not recall.done.is_set():
+                    fail_recall(recall, archive_id)
+
+
+recall_queue = RecallQueue()
+
+
+def remove_partial(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def lookup_members(options, archive_id, original_ids):
+    entries = get_db(options['mongoUrl']).archive_index.find({'archiveId': archive_id,
+                                                               'pnfsid': {'$in': list(original_ids)}})
+    return {entry['pnfsid']: dcapzip.Member.from_index(entry) for entry in entries}
+
+
+def restore_batch(options, archive_id, batch):
+    # With index entries only the members' ranges are read over dcap, the archive's central directory (or index, for
+    # containers in the indexed format) is read only for members without one.
+    members = lookup_members(options, archive_id, {recall.original_id for recall in batch})
+    recalls = {}
+    for recall in batch:
+        recalls.setdefault(recall.original_id, []).append(recall)
+
+    start = time.time()
+    restored = 0
+    with get_dcap_pool(options['dcapDoor']).open_file(archive_id, 'r') as archive:
+        if len(members) < len(recalls):
+            logging.info(f"{len(recalls) - len(members)} files without index entry in archive {archive_id}, "
+                         f"reading its directory")
+            for member in dcapzip.iter_members(archive):
+                if member.name in recalls and member.name not in members:
+                    members[member.name] = member
+
+        # requests for the same file share one extraction
+        targets = {}
+        for original_id, waiting in recalls.items():
+            for recall in waiting:
+                if original_id not in members:
+                    logging.error(f"{original_id} There is no item named {original_id} in archive {archive_id}")
+                    fail_recall(recall, archive_id)
+                elif recall.filename not in targets:
+                    targets[recall.filename] = (members[original_id], [recall])
+                elif targets[recall.filename][0] is members[original_id]:
+                    targets[recall.filename][1].append(recall)
+                else:
+                    logging.error(f"{original_id} {recall.filename} is requested for another file of archive "
+                                  f"{archive_id} as well")
+                    # the file belongs to the other request, it is not removed
+                    recall.error = HsmError(243, f"Couldn't replay the file from archive {archive_id}. Check the log "
+                                                 f"for details!")
+                    recall.done.set()
+
+        logging.info(f"Extracting {len(targets)} files from archive {archive_id}")
+        for member, filename, error in dcapzip.extract_members(
+                archive, [(member, filename) for filename, (member, _) in targets.items()]):
+            if error is None:
+                logging.info(f"{member.name} Extracted {member.file_size} bytes into {filename}")
+                restored += member.file_size
+                for recall in targets[filename][1]:
+                    recall.done.set()
+            else:
+                logging.error(f"{member.name} Extraction from archive {archive_id} failed: {str(error)}")
+                for recall in targets[filename][1]:
+                    fail_recall(recall, archive_id)
+
+    elapsed = time.time() - start
+    logging.info(f"Restored {len(batch)} files, {restored} bytes from archive {archive_id} in {elapsed:.1f} s")
+
+
+def fail_recall(recall, archive_id):
+    remove_partial(recall.filename)
+    recall.error = HsmError(243, f"Couldn't replay the file from archive {archive_id}. Check the log for details!")
+    recall.done.set()
+
+
+def extract(options, archive_id, original_id, filename):
+    logging.info(f"{original_id} Queueing extraction into {filename}")
+    recall_queue.submit(options, archive_id, original_id, filename)
+
+
+def get(options, pnfsid, filename):
+    uri = options.get('uri', '')
+    store, group, bfid = parse_uri(uri)
+    logging.info(f"{pnfsid} Store={store}; Group={group}; Bfid={bfid}")
+
+    if ':' not in bfid:
+        raise HsmError(243, f"This is not an small files archive : {bfid}")
+    original_id, _, archive_id = bfid.rpartition(':')
+
+    if archive_id == '*':
+        logging.info(f"{pnfsid} Restoring 0-byte file: {original_id}.")
+        return None
+    elif original_id == '*':
+        logging.info(f"{pnfsid} Restoring old faulty entry for 0-byte file. To fix set bfid to "
+                     f"{original_id}:{archive_id}")
+        return None
+
+    extract(options, archive_id, original_id, filename)
+    logging.info(f"{pnfsid} Extraction finished, done")
+    return None
+
+
+def handle_request(args):
+    pnfsid = None
+    try:
+        positional, options = parse_args(args)
+        if len(positional) < 3:
+            raise HsmError(4, "Usage : put|get <pnfsId> <filePath> [-si=<storageInfo>] [-key[=value] ...]")
+        command, pnfsid, filename = positional[:3]
+
+        for key in ('dcapLib', 'dcapDoor', 'mongoUrl'):
+            if not options.get(key):
+                raise HsmError(3, f"Variable '{key}' not defined")
+        if not options.get('si'):
+            raise HsmError(1, "StorageInfo (-si=...) not available")
+        storage_info = parse_storage_info(options['si'])
+
+        if command == 'get':
+            output = get(options, pnfsid, filename)
+        elif command == 'put':
+            output = put(options, pnfsid, filename, storage_info)
+        elif command == 'next':
+            raise HsmError(10, "'next' operation not supported by this HSM")
+        else:
+            raise HsmError(4, f"Illegal command {command}")
+        return 0, output, None
+
+    except HsmError as e:
+        logging.warning(f"{pnfsid} {str(e)}")
+        return e.rc, None, e.message
+    except errors.PyMongoError as e:
+        logging.error(f"{pnfsid} Error running mongo query: {str(e)}")
+        return 102, None, "Error running mongo query"
+
+
+class HsmRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        rc, output, message = handle_request(json.loads(line)['args'])
+        self.wfile.write((json.dumps({'rc': rc, 'output': output, 'message': message}) + '\n').encode('utf-8'))
+
+
+def main(path=socket_path):
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    log_handler = logging.handlers.WatchedFileHandler('/var/log/dcache/hsm-helper.log')
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(name)-10s %(levelname)-8s %(message)s'))
+    logger.addHandler(log_handler)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, HsmRequestHandler)
+    server.daemon_threads = True
+    os.chmod(path, 0o660)
+
+    def shutdown_handler(signum, frame):
+        logging.info(f"Caught signal {signum}.")
+        # shutdown() waits for serve_forever(), which runs in this very thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
+
+    logging.info(f"Serving HSM requests on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        for client in clients.values():
+            client.close()
+        for pool in dcap_pools.values():
+            pool.close()
+        logging.info("Exiting.")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        main()
+    elif len(sys.argv) == 2:
+        main(sys.argv[1])
+    else:
+        print("Usage: hsm-helper.py [<socket>]")
+        sys.exit(1)
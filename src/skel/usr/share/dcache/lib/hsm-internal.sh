@@ -9,6 +9,8 @@
 #
 #   hsm set dcache -command=<fullPathToThisScript> # e.g., /usr/share/dcache/lib/hsm-internal.sh
 #   hsm set dcache -mongoUrl=<urlOfMongoDb> # e.g., server.example.org/database
+#   hsm set dcache -recallDelay=<seconds> # optional, how long hsm-helper.py collects restores of one archive
+#   hsm set dcache -recallTimeout=<seconds> # optional, how long hsm-helper.py waits for a restore, default 3600
 #
 #########################################################
 #
@@ -17,6 +19,10 @@
 LOG=/var/log/dcache/hsm-internal.log
 DEVTTY=$LOG
 AWK=gawk
+HELPER_SOCKET=/var/run/dcache/hsm-helper.sock
+HELPER_CLIENT=/usr/share/dcache/lib/hsm-client.py
+HELPER_UNREACHABLE=111
+DCAPZIP=/usr/share/dcache/lib/dcapzip.py
 #
 #
 #########################################################
@@ -121,6 +127,19 @@ fi
 #
 ##################################################################################
 #
+# If the HSM helper is running, let it handle the request. It keeps its
+# MongoDB connections open and does not need the forks below.
+#
+if [ -S "${HELPER_SOCKET}" ] ; then
+   ${HELPER_CLIENT} "${HELPER_SOCKET}" "$@"
+   rc=$?
+   [ ${rc} -ne ${HELPER_UNREACHABLE} ] && exit ${rc}
+   errorReport "HSM helper not reachable on ${HELPER_SOCKET}, handling request in script"
+fi
+#
+#
+##################################################################################
+#
 # split the arguments into the options -<key>=<value> and the 
 # positional arguments.
 #
@@ -223,17 +242,15 @@ if [ $command = "get" ] ; then
      exit 0
    fi
    #
-   extractDir=`dirname "${filename}"`
+   report "Extracting file into ${filename}"
    #
-   report "Extracting file into $extractDir"
-   #
-   cd "${extractDir}"
-   report "Preloading ${dcapLib}"
-   export LD_PRELOAD="${dcapLib}"
-   unzip "pnfs://${dcapDoor}/${archiveId}" "${originalId}" 2>>$LOG
+   # dcapzip.py reads zip and indexed containers, and members unzip can't decompress (e.g. zstd)
+   python3 "${DCAPZIP}" "dcap://${dcapDoor}" "${archiveId}" "${originalId}" "${filename}" 2>>$LOG
    rc=$?
-   cd -
-   if [ $rc -ne 0 ] ; then problem 243 "Unzip couldn't replay the file($rc). Check the log for details!" ; fi
+   if [ $rc -ne 0 ] ; then
+      rm -f "${filename}"
+      problem 243 "dcapzip.py couldn't replay the file($rc). Check the log for details!"
+   fi
    #
    report "Extraction finished, done"
    #